@@ -0,0 +1,132 @@
+# -*- coding: utf-8  -*-
+# In-memory stand-in for the parts of pywikibot's Site and Page the bot uses.
+
+import threading, time
+from collections import Counter
+
+import pywikibot
+
+class Revision:
+    def __init__(self, revid, text, user):
+        self.revid = revid
+        self.text = text
+        self.user = user
+
+class FakeSite:
+    def __init__(self, pages = {}, messages = {}, latency = 0, code = 'pl'):
+        self.code = code
+        self.latency = latency
+        self.messages = dict(messages)
+        self.requests = Counter()
+        self._pages = {}
+        self._revid = 0
+        self._lock = threading.Lock()
+        for title, text in pages.items():
+            self.store(normalize(title), text, 'Fixture')
+
+    def __str__(self):
+        return 'fake:{}'.format(self.code)
+
+    @property
+    def sitename(self):
+        return str(self)
+
+    def username(self):
+        return 'Bot'
+
+    def login(self):
+        pass
+
+    def request(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def store(self, title, text, user):
+        with self._lock:
+            self._revid += 1
+            self._pages.setdefault(title, []).append(Revision(self._revid, text, user))
+            return self._revid
+
+    def history(self, title):
+        return self._pages.get(title, [])
+
+    def mediawiki_message(self, key):
+        self.request('message')
+        return self.messages[key]
+
+    def preloadpages(self, pages, groupsize = 50):
+        pages = list(pages)
+        for i in range(0, len(pages), groupsize):
+            self.request('preload')
+            for page in pages[i:i + groupsize]:
+                page.load()
+                yield page
+
+    def loadrevisions(self, page, content = False, startid = None, total = None, **kwargs):
+        self.request('revisions')
+        revs = [rev for rev in reversed(self.history(page.title())) if startid is None or rev.revid <= startid]
+        for rev in revs[:total]:
+            page._revisions[rev.revid] = rev
+
+def normalize(title, ns = 828):
+    if ns == 828 and not title.startswith('Module:'):
+        title = 'Module:' + title
+    return title
+
+class FakePage:
+    def __init__(self, site, title, ns = 0):
+        self.site = site
+        self._title = normalize(title, ns)
+        self._revisions = {}
+        self._loaded = False
+
+    def __repr__(self):
+        return 'FakePage({})'.format(self._title)
+
+    def title(self, with_ns = True, **kwargs):
+        if with_ns:
+            return self._title
+        return self._title.split(':', 1)[-1]
+
+    def load(self, force = False):
+        if self._loaded and not force:
+            return
+        history = self.site.history(self._title)
+        self._latest = history[-1] if len(history) else None
+        self._loaded = True
+
+    def _fetch(self, kind):
+        if not self._loaded:
+            self.site.request(kind)
+            self.load()
+
+    def exists(self):
+        self._fetch('info')
+        return self._latest is not None
+
+    def get(self, force = False, get_redirect = False):
+        if force:
+            self._loaded = False
+        self._fetch('read')
+        if self._latest is None:
+            raise pywikibot.exceptions.NoPage(self)
+        return self._latest.text
+
+    @property
+    def text(self):
+        return self.get()
+
+    @property
+    def latest_revision_id(self):
+        self._fetch('info')
+        if self._latest is None:
+            raise pywikibot.exceptions.NoPage(self)
+        return self._latest.revid
+
+    def put(self, text, summary = None, **kwargs):
+        self.site.request('write')
+        self.site.store(self._title, text, self.site.username())
+        self._loaded = False
+        self.load()
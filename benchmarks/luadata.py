@@ -0,0 +1,69 @@
+# -*- coding: utf-8  -*-
+# Compares include.luadata with include.luad on a list module of realistic size.
+#
+#   python benchmarks/luadata.py [wikis] [rounds]
+
+import sys, random
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from include import luad, luadata
+
+def makeList(count, seed = 0):
+    rnd = random.Random(seed)
+    wikis = {}
+    for id in rnd.sample(range(1, 2000000), count):
+        code = 'wiki{:d}'.format(id)
+        wikis[id] = {
+            'id': id,
+            'name': 'Wiki {:d} \'{}\''.format(id, rnd.choice(['Fandom', 'Encyklopedia', 'Wiki'])),
+            'domain': code + '.fandom.com',
+            'code': code,
+            'language': rnd.choice(['pl', 'en', 'de', 'fr']),
+            'hub': rnd.choice(['Gaming', 'Entertainment', 'Lifestyle']),
+            'discussions': rnd.random() < 0.5,
+            'wordmark': None if rnd.random() < 0.3 else 'https://vignette.wikia.nocookie.net/{}/images/wordmark.png'.format(code),
+            'image': None,
+            'stats': {
+                'edits': rnd.randint(0, 10**6),
+                'articles': rnd.randint(0, 10**5),
+                'pages': rnd.randint(0, 10**5),
+                'images': rnd.randint(0, 10**4),
+                'videos': rnd.randint(0, 100),
+                'admins': rnd.randint(0, 20),
+                'activeUsers': rnd.randint(0, 500),
+                'activeAdmins': rnd.randint(0, 10),
+            },
+        }
+    return {'wikis': wikis, 'updated_timestamp': 1500000000}
+
+def measure(fn, rounds):
+    best = None
+    for i in range(rounds):
+        start = perf_counter()
+        fn()
+        took = perf_counter() - start
+        best = took if best is None else min(best, took)
+    return best
+
+def main(count = 5000, rounds = 3):
+    data = makeList(count)
+    text = 'return ' + luadata.dumps(data, indent = 4)
+    print('{:d} wikis, {:.1f} MB of Lua'.format(count, len(text) / 2**20))
+
+    if luadata.loads(text) != data:
+        raise SystemExit('luadata round trip does not match the input')
+
+    results = [
+        ('luadata.dumps', measure(lambda: luadata.dumps(data, indent = 4), rounds)),
+        ('luadata.loads', measure(lambda: luadata.loads(text), rounds)),
+        ('luad.dumps', measure(lambda: luad.dumps(data, indent = 4), rounds)),
+        ('luad.loads', measure(lambda: luad.loads(text), rounds)),
+    ]
+    for label, took in results:
+        print('{:<15} {:8.3f}s'.format(label, took))
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,186 @@
+# -*- coding: utf-8  -*-
+# Runs Bot.step1 - Bot.end against the local stand-ins and reports per-step
+# timings, request counts and peak memory. Every fixture size runs in its
+# own process so that the module-level registries start empty.
+#
+#   python benchmarks/offline.py [-wikis 1000,10000,50000] [-latency 0.05]
+#                                [-errors 0.01] [-pagelatency 0.1] [-tracemalloc]
+#                                [-shards language|N] [-sites N] [-json report.json]
+#                                [-roundtrip] [bot args...]
+#
+# With -roundtrip every run is recorded to a cassette and then replayed, which
+# has to finish without a single HTTP request.
+# With -sites several fake sites with overlapping lists run in one cycle.
+#
+# Peak memory is the process' maximum RSS, or the traced Python heap with
+# -tracemalloc (slower).
+
+import os, sys, json, subprocess, tempfile, random
+from pathlib import Path
+from time import perf_counter
+from collections import Counter
+
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+steps = ['step1', 'step2', 'step3', 'end', 'saveList', 'saveQueue', 'saveAliases', 'saveRemoved', 'saveWikis']
+
+def modules(fixture, shards = None, listed = 0.6, queued = 20, seed = 0):
+    from include import luadata
+    from include.wiki import getCode
+    rnd = random.Random(seed)
+    wikis = {}
+    pages = {}
+    for id, wiki in fixture.wikis.items():
+        if rnd.random() >= listed:
+            continue
+        domain = wiki['url'][8:-1]
+        wikis[id] = {
+            'id': id,
+            'name': wiki['name'],
+            'domain': domain,
+            'code': getCode(domain),
+            'language': wiki['lang'],
+            'hub': wiki['hub'],
+            'discussions': True,
+            'stats': {key: value for key, value in wiki['stats'].items() if key != 'users'},
+        }
+        data = dict(wikis[id], stats = {'2000-01-01': wikis[id]['stats']}, updated_timestamp = 0)
+        pages['Lista/wiki/{:d}'.format(id)] = 'return ' + luadata.dumps(data, indent = 4)
+
+    pages['Lista/wiki'] = 'return ' + luadata.dumps({'wikis': wikis, 'updated_timestamp': 0}, indent = 4)
+
+    unlisted = [wiki for id, wiki in fixture.wikis.items() if id not in wikis]
+    queue = [wiki['url'][8:-1] for wiki in rnd.sample(unlisted, min(queued, len(unlisted)))]
+    queue += [fixture.missing[0]] if len(fixture.missing) else []
+    queue += ['https://{}/wiki/Main_Page'.format(queue[0]), 'missing.fandom.com'] if len(queue) else []
+    pages['Wikis/queue'] = 'return ' + luadata.dumps(queue, indent = 4)
+
+    from benchmarks.standin import languages
+    pages['Wikis/settings'] = 'return ' + luadata.dumps({
+        'languages': languages,
+        'list_shards': int(shards) if shards is not None and shards.isdigit() else shards,
+        'modules': {
+            'list': 'Lista/wiki',
+            'queue': 'Wikis/queue',
+            'aliases': 'Wikis/aliases',
+            'removed': 'Wikis/removed',
+        },
+    }, indent = 4)
+    return pages
+
+def run(count, latency, errors, pagelatency, shards, trace, args, sites = 1):
+    os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '1')
+    import pywikibot, tracemalloc, resource
+    from benchmarks import standin
+    from benchmarks.fakesite import FakeSite, FakePage
+    from include import pool, tools
+    import include.bot
+
+    process, address = standin.spawn(count, latency, errors)
+    fixture = standin.Fixture(count)
+    fakes = {'site{:d}'.format(i): FakeSite(modules(fixture, shards, seed = i), {'custom-list-bot-module': 'Wikis/settings'}, latency = pagelatency, code = 'site{:d}'.format(i)) for i in range(sites)}
+    site = fakes['site0']
+
+    quiet = lambda *args, **kwargs: None
+    pywikibot.Site = lambda code = None, fam = None, *args, **kwargs: fakes.get(code, site)
+    pywikibot.handle_args = lambda *a, **kw: ['-always'] + args
+    pywikibot.page.Page = FakePage
+    pywikibot.showDiff = quiet
+    pywikibot.input_choice = lambda *args, **kwargs: 'y'
+    include.bot.output = quiet
+    tools.progressBar = quiet
+    tools.dataDir = tempfile.mkdtemp(prefix = 'wikilistbot-bench-')
+    pool.override = ('http', address)
+
+    timings = {}
+    def timed(name, fn):
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings[name] = timings.get(name, 0) + perf_counter() - start
+        return wrapper
+    for name in steps:
+        setattr(include.bot.Bot, name, timed(name, getattr(include.bot.Bot, name)))
+
+    if trace:
+        tracemalloc.start()
+    start = perf_counter()
+    if sites > 1:
+        from include import multisite
+        multisite.run(sorted(fakes), ['-always'] + args)
+    else:
+        bot = include.bot.Bot()
+        bot.run()
+    total = perf_counter() - start
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    requests = standin.stats(address)
+    process.terminate()
+
+    return {
+        'wikis': count,
+        'total': total,
+        'steps': timings,
+        'http_requests': requests,
+        'site_requests': dict(sum((fake.requests for fake in fakes.values()), Counter())),
+        'peak_memory': peak,
+    }
+
+def show(count, result, label = ''):
+    print('\n=== {:d} wikis{}: {:.2f}s, peak memory {:.1f} MB ==='.format(count, ', ' + label if label else '', result['total'], result['peak_memory'] / 2**20))
+    for name in steps:
+        if name in result['steps']:
+            print('  {:<12} {:9.3f}s'.format(name, result['steps'][name]))
+    for label, counts in [('HTTP', result['http_requests']), ('Site', result['site_requests'])]:
+        print('  {} requests: {:d} ({})'.format(label, sum(counts.values()), ', '.join('{} {:d}'.format(key, value) for key, value in sorted(counts.items()))))
+
+def main(argv):
+    sizes, latency, errors, pagelatency, shards, sites, report, single, trace, roundtrip, args = [1000, 10000, 50000], 0.0, 0.0, 0.0, None, 1, None, None, False, False, []
+    it = iter(argv)
+    for arg in it:
+        if arg == '-wikis':         sizes = [int(x) for x in next(it).split(',')]
+        elif arg == '-latency':     latency = float(next(it))
+        elif arg == '-errors':      errors = float(next(it))
+        elif arg == '-pagelatency': pagelatency = float(next(it))
+        elif arg == '-shards':      shards = next(it)
+        elif arg == '-sites':       sites = max(1, int(next(it)))
+        elif arg == '-json':        report = next(it)
+        elif arg == '-tracemalloc': trace = True
+        elif arg == '-run':         single = int(next(it))
+        elif arg == '-roundtrip':   roundtrip = True
+        else: args.append(arg)
+    
+    if single is not None:
+        print(json.dumps(run(single, latency, errors, pagelatency, shards, trace, args, sites)))
+        return
+
+    results = []
+    for count in sizes:
+        cmd = [sys.executable, __file__, '-latency', str(latency), '-errors', str(errors), '-pagelatency', str(pagelatency), '-run', str(count)] + (['-shards', shards] if shards is not None else []) + ['-sites', str(sites)] + (['-tracemalloc'] if trace else []) + args
+        if roundtrip:
+            tape = os.path.join(tempfile.mkdtemp(prefix = 'wikilistbot-tape-'), 'run.sqlite3')
+            runs = [('recorded', cmd + ['-record:' + tape]), ('replayed', cmd + ['-replay:' + tape])]
+        else:
+            runs = [('', cmd)]
+        
+        for label, cmd in runs:
+            out = subprocess.run(cmd, stdout = subprocess.PIPE, check = True, universal_newlines = True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            results.append(result)
+            show(count, result, label)
+        
+        if roundtrip and sum(result['http_requests'].values()):
+            sys.exit('Replay of {:d} wikis went to the network'.format(count))
+
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
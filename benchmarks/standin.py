@@ -0,0 +1,205 @@
+# -*- coding: utf-8  -*-
+# Local stand-in for the Fandom endpoints the bot talks to, serving synthetic
+# wikis with configurable latency and error rate.
+
+import json, random, threading, time
+import http.server, socketserver, urllib.parse
+from collections import Counter
+from datetime import datetime, timedelta
+
+languages = ['pl', 'en', 'de', 'fr', 'es', 'ru', 'it', 'ja']
+hubs = ['Gaming', 'Entertainment', 'Lifestyle']
+months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
+
+class Fixture:
+    def __init__(self, count, seed = 0, closed = 0.02, invalid = 0.01):
+        rnd = random.Random(seed)
+        self.seed = seed
+        self.wikis = {}
+        self.missing = []
+        for id in sorted(rnd.sample(range(1, 10 * count + 100), count)):
+            code = 'wiki{:d}'.format(id)
+            if rnd.random() < invalid:
+                self.missing.append(id)
+                continue
+            self.wikis[id] = {
+                'id': id,
+                'name': 'Wiki {:d}'.format(id),
+                'url': 'https://{}.fandom.com/'.format(code),
+                'domain': '' if rnd.random() < closed else code + '.fandom.com',
+                'lang': rnd.choice(languages),
+                'hub': rnd.choice(hubs),
+                'wordmark': '',
+                'image': '',
+                'stats': {
+                    'users': rnd.randint(0, 10**5),
+                    'edits': rnd.randint(0, 10**6),
+                    'articles': rnd.randint(0, 10**5),
+                    'pages': rnd.randint(0, 10**5),
+                    'images': rnd.randint(0, 10**4),
+                    'videos': rnd.randint(0, 100),
+                    'admins': rnd.randint(1, 20),
+                    'activeUsers': rnd.randint(0, 500),
+                    'discussions': rnd.randint(0, 1000),
+                },
+                'wam': rnd.random() * 100,
+            }
+        self.ids = sorted(list(self.wikis) + self.missing)
+        self.byDomain = {wiki['url'][8:-1]: wiki for wiki in self.wikis.values()}
+        self._wam = {}
+
+    def details(self, ids):
+        items = {}
+        for id in ids:
+            wiki = self.wikis.get(id)
+            if wiki is not None:
+                items[str(id)] = {key: value for key, value in wiki.items() if key != 'wam'}
+                items[str(id)]['stats'] = dict(wiki['stats'])
+        return {'items': items}
+
+    def wam(self, lang, limit, offset):
+        if lang not in self._wam:
+            self._wam[lang] = sorted([wiki for wiki in self.wikis.values() if lang is None or wiki['lang'] == lang], key = lambda wiki: -wiki['wam'])
+        lst = self._wam[lang]
+        return {'wam_index': {str(wiki['id']): {'wam': wiki['wam']} for wiki in lst[offset:offset + limit]}}
+
+    def variables(self, domain):
+        wiki = self.byDomain[domain]
+        return {'data': {
+            'id': wiki['id'],
+            'mainPageTitle': 'Main Page',
+            'wikiCategories': ['games'],
+            'favicon': None,
+            'disableAnonymousEditing': False,
+            'isCoppaWiki': False,
+            'isDarkTheme': False,
+            'siteMessage': wiki['name'],
+            'theme': {'color-body': '#000000', 'color-links': '#ffffff'},
+        }}
+
+    def users(self, domain, limit, offset, order = None):
+        wiki = self.byDomain[domain]
+        rnd = random.Random(wiki['id'] + self.seed)
+        total = wiki['stats']['admins'] + rnd.randint(0, 10)
+        now = datetime.now()
+        rows = []
+        dates = [now - timedelta(days = i * rnd.randint(1, 30)) for i in range(total)]
+        if order == 'dtedit:desc':
+            dates.sort(reverse = True)
+        for i, date in enumerate(dates):
+            groups = 'bureaucrat, sysop' if i == 0 else 'sysop' if i < wiki['stats']['admins'] else 'threadmoderator'
+            rows.append([
+                '<a href="/wiki/User:User{0:d}">User{0:d}</a>'.format(i),
+                '<a href="/wiki/Special:Contributions/User{:d}">{:02d}:{:02d}, {} {:d}, {:d}</a>'.format(i, date.hour, date.minute, months[date.month - 1], date.day, date.year),
+                groups,
+                '<a href="/wiki/Special:Contributions/User{:d}">{:d}</a>'.format(i, rnd.randint(1, 10000)),
+            ])
+        return {
+            'sColumns': 'username,dtedit,groups,revcnt',
+            'iTotalRecords': total,
+            'iTotalDisplayRecords': total,
+            'aaData': rows[offset:offset + limit],
+        }
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, data = None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        parts = urllib.parse.urlsplit(self.path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(parts.query).items()}
+        host = self.headers.get('Host', '')
+
+        if parts.path == '/__stats':
+            return self.reply(200, dict(server.requests))
+        if parts.path.endswith('/Wikis/Details'):
+            endpoint = 'Wikis/Details'
+        elif parts.path.endswith('/WAM/WAMIndex'):
+            endpoint = 'WAM/WAMIndex'
+        elif parts.path.endswith('/Mercury/WikiVariables'):
+            endpoint = 'Mercury/WikiVariables'
+        elif parts.path.endswith('/index.php') and query.get('rs') == 'ListusersAjax::axShowUsers':
+            endpoint = 'ListusersAjax'
+        else:
+            endpoint = 'unknown'
+        server.count(endpoint)
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random() < server.error_rate:
+            return self.reply(503)
+
+        fixture = server.fixture
+        try:
+            if endpoint == 'Wikis/Details':
+                return self.reply(200, fixture.details([int(x) for x in query['ids'].split(',') if x]))
+            if endpoint == 'WAM/WAMIndex':
+                return self.reply(200, fixture.wam(query.get('wiki_lang'), int(query.get('limit', 20)), int(query.get('offset', 0))))
+            if endpoint == 'Mercury/WikiVariables':
+                return self.reply(200, fixture.variables(host))
+            if endpoint == 'ListusersAjax':
+                return self.reply(200, fixture.users(host, int(query.get('limit', 100)), int(query.get('offset', 0)), query.get('order')))
+        except KeyError:
+            return self.reply(404, {})
+        self.reply(404, {})
+
+class StandIn(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixture, latency = 0, error_rate = 0, seed = 0):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.fixture = fixture
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def address(self):
+        return '{}:{:d}'.format(*self.server_address)
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, daemon = True)
+        thread.start()
+        return self
+
+def serve(conn, count, latency, error_rate):
+    server = StandIn(Fixture(count), latency = latency, error_rate = error_rate)
+    conn.send(server.address)
+    server.serve_forever()
+
+def spawn(count, latency = 0, error_rate = 0):
+    # Runs the stand-in in a separate process so that it neither competes for
+    # the bot's GIL nor shows up in its memory usage. Returns the process and
+    # the address it listens on.
+    import multiprocessing
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target = serve, args = (child, count, latency, error_rate), daemon = True)
+    process.start()
+    return process, parent.recv()
+
+def stats(address):
+    import urllib.request
+    with urllib.request.urlopen('http://{}/__stats'.format(address)) as response:
+        return json.loads(response.read().decode('utf-8'))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8  -*-
+# Local copy of the aliases module as a two-way index: code -> id for lookups
+# and id -> codes so that a removed wiki drops all of its aliases at once. It
+# is only trusted while the manifest says the module still holds exactly what
+# the bot saved last.
+
+import json
+from collections import defaultdict
+
+from include import manifest, tools
+from include.wiki import getCode, normalizeURL
+
+class AliasIndex:
+    def __init__(self, path):
+        self.path = path
+        self.codes = {}
+        self.ids = defaultdict(set)
+        self.rebuilt = False
+        self.source = None # Module data the index was rebuilt from
+        self._lower = None
+        try:
+            with open(str(path), encoding = 'utf-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            data = {}
+        for code, id in data.items():
+            self.add(code, id)
+
+    def add(self, code, id):
+        id = int(id)
+        old = self.codes.get(code)
+        if old == id:
+            return
+        if old is not None:
+            self.ids[old].discard(code)
+        self.codes[code] = id
+        self.ids[id].add(code)
+        self._lower = None
+
+    def remove(self, id):
+        for code in self.ids.pop(id, ()):
+            del self.codes[code]
+        self._lower = None
+
+    def clear(self):
+        self.codes = {}
+        self.ids.clear()
+        self._lower = None
+
+    def rebuild(self, data, wikis):
+        # Same rules the module has always been built with: aliases of wikis
+        # that are no longer listed are dropped and the rest is normalized
+        self.clear()
+        self.rebuilt = True
+        self.source = data
+        for alias, id in (data if isinstance(data, dict) else {}).items():
+            if id in wikis:
+                self.add(getCode(str(alias)), id)
+
+    def lookup(self, code):
+        try:
+            return self.codes[code]
+        except KeyError:
+            pass
+        if self._lower is None:
+            self._lower = {normalizeURL(key): id for key, id in self.codes.items()}
+        return self._lower.get(code)
+
+    def digest(self):
+        return manifest.payloadHash(self.codes)
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(str(tmp), 'w', encoding = 'utf-8') as f:
+            json.dump(self.codes, f)
+        tmp.replace(self.path)
+
+def forSite(site):
+    return AliasIndex(tools.siteFile('aliases', site, '.json'))
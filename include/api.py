@@ -1,101 +1,290 @@
 # -*- coding: utf-8  -*-
 
-import urllib.parse, urllib.request, urllib.error, json, time, re
-from socket import error as socket_error
+import urllib.parse, urllib.request, urllib.error, json, time, re, threading
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from socket import error as socket_error, gaierror
+
+from include import pool, cache, metrics, retry
+from include.cache import cached
 
 __server = 'https://www.wikia.com/api/v1/'
 languages = None
 
-__cache = {}
-def cached(fn):
-    name = fn.__module__ + '.' + fn.__name__
+concurrency = 4
+details_batch = 250
+wam_page = 20 # API breaks when limit is above 20 atm
+
+# Set to a dict while several sites are run in one cycle (see multisite.py),
+# so that Details and WAM pages needed by more than one site are fetched once
+shared = None
+
+retry.exempt.add(urllib.parse.urlsplit(__server).netloc)
+
+def tryJSON(url, attempt = 0, tries = retry.tries):
+    # Makes a single request. Returns (data, None) on success or (None, delay)
+    # when the request should be repeated after delay seconds. An open breaker
+    # only turns new requests away, started ones use up their own tries
+    breaker = retry.breaker(url)
+    if attempt == 0 and not breaker.allow():
+        raise JSONError('Host keeps failing, skipping request', url)
+    try:
+        data = json.loads(pool.request(url).decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        if e.code in [404, 410]:
+            breaker.success()
+            raise
+        error, message = e, str(e)
+    except urllib.error.URLError as e:
+        e.url = url
+        if not (isinstance(e.reason, gaierror) or str(e).find('getaddrinfo') > -1):
+            raise
+        error, message = e, 'Host not found'
+    except socket_error as e:
+        error, message = e, str(e)
+    except (ValueError, json.decoder.JSONDecodeError) as e:
+        breaker.success()
+        raise JSONError('No JSON object could be decoded', url)
+    else:
+        breaker.success()
+        return data, None
     
-    def decorator(*args, **kwargs):
-        t = (name, hash(args), hash(hash(frozenset(kwargs.items()))))
-        if t in __cache:
-            return __cache[t]
-        
-        data = fn(*args, **kwargs)
-        
-        __cache[t] = data
-        return data
-    return decorator
+    if breaker.failure():
+        print('{0} keeps failing, skipping its requests for {1} seconds'.format(urllib.parse.urlsplit(url).netloc, retry.cooldown))
+    if attempt + 1 >= tries:
+        raise JSONError('Failed after {0} tries'.format(tries), url, error)
+    d = retry.delay(attempt, error)
+    print('{0}, retrying in {1:.1f} seconds'.format(message, d))
+    metrics.current.retry(url)
+    return None, d
+
+@metrics.timed
+def getJSON(url, tries = retry.tries):
+    attempt = 0
+    while True:
+        data, d = tryJSON(url, attempt, tries)
+        if d is None:
+            return data
+        time.sleep(d)
+        attempt += 1
 
-def getJSON(url, tries = 5, delay = 3):
-    t, d = tries, delay
-    while t > 1:
+def submitJSON(url, tries = retry.tries, waiting = None):
+    # Same as pool.submit(getJSON, url), except that backoff delays are waited
+    # out on a timer instead of in a pool worker. waiting(True) and
+    # waiting(False) are called when a backoff starts and ends
+    future = Future()
+    def resume(attempt):
+        if waiting is not None:
+            waiting(False)
+        pool.submit(run, attempt)
+    def run(attempt):
+        if attempt == 0 and not future.set_running_or_notify_cancel():
+            return
         try:
-            t -= 1
-            with urllib.request.urlopen(url) as response:
-                return json.loads(response.read().decode('utf-8'))
-        except urllib.error.HTTPError as e:
-            if e.code in [404, 410]: raise
-            print('{0}, retrying in {1} seconds'.format(str(e), d))
-            time.sleep(d)
-            d *= 2
-        except urllib.error.URLError as e:
-            e.url = url
-            if str(e).find('getaddrinfo') > -1:
-                print('Host not found, retrying in {0} seconds'.format(d))
-                time.sleep(d)
-                d *= 2
-            else:
-                raise
-        except socket_error as e:
-            print('{0}, retrying in {1} seconds'.format(str(e), d))
-            time.sleep(d)
-        except (ValueError, json.decoder.JSONDecodeError) as e:
-            raise JSONError('No JSON object could be decoded', url)
-    raise JSONError('Failed after {0} tries'.format(tries), url)
+            with metrics.timer('getJSON'):
+                data, d = tryJSON(url, attempt, tries)
+        except Exception as e:
+            return future.set_exception(e)
+        if d is None:
+            return future.set_result(data)
+        if waiting is not None:
+            waiting(True)
+        timer = threading.Timer(d, resume, (attempt + 1,))
+        timer.daemon = True
+        timer.start()
+    pool.submit(run, 0)
+    return future
         
 class JSONError(Exception):
-    def __init__(self, value, url):
+    def __init__(self, value, url, error = None):
         self.value = value
         self.url = url
+        self.error = error # Last error when the request ran out of tries
     def __str__(self):
         return '%s (%s)' % (str(self.value), self.url)
 
-def call(path, query = {}, server = None):
+def notFound(error):
+    # Whether a failed request means there is nothing at the url, as opposed
+    # to a server or network problem that may go away
+    if isinstance(error, JSONError):
+        error = error.error
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in [404, 410]
+    if isinstance(error, urllib.error.URLError):
+        return isinstance(error.reason, gaierror) or str(error).find('getaddrinfo') > -1
+    return False
+
+def getURL(path, query = {}, server = None):
     qs = urllib.parse.urlencode(query)
-    url = ''.join([server or __server, path, '?' if qs else '', qs])
-    return getJSON(url)
+    return ''.join([server or __server, path, '?' if qs else '', qs])
+
+def call(path, query = {}, server = None):
+    return getJSON(getURL(path, query, server))
+
+def submit(path, query = {}, server = None, waiting = None):
+    return submitJSON(getURL(path, query, server), waiting = waiting)
+
+def then(future, fn):
+    # Future of fn(future.result()); cancelling it cancels the request as well
+    res = Future()
+    def done(future):
+        try:
+            value = fn(future.result())
+        except Exception as e:
+            value, error = None, e
+        else:
+            error = None
+        try:
+            if error is None:
+                res.set_result(value)
+            else:
+                res.set_exception(error)
+        except Exception:
+            pass # Cancelled in the meantime
+    future.add_done_callback(done)
+    res.add_done_callback(lambda res: res.cancelled() and future.cancel())
+    return res
 
 @cached
 def getWikiVariables(url):
     server = 'http://' + url + '/api/v1/'
     return call('Mercury/WikiVariables', server = server)['data']
 
-def getDetails(ids):
+def submitWikiVariables(url):
+    # Same as getWikiVariables, but built on submitJSON so that no pool worker
+    # sleeps through the backoff
+    key = cache.makeKey([url])
+    found, data = cache.lookup('include.api.getWikiVariables', key)
+    if found:
+        future = Future()
+        future.set_result(data)
+        return future
+    def store(data):
+        cache.store('include.api.getWikiVariables', key, data['data'])
+        return data['data']
+    return then(submit('Mercury/WikiVariables', server = 'http://' + url + '/api/v1/'), store)
+
+def iterDetails(ids, workers = None):
     if isinstance(ids, (int, str)): ids = [ids]
     ids = [int(i) for i in ids]
     
+    known = {}
+    missing = []
+    for id in ids:
+        if shared is not None and ('Wikis/Details', id) in shared:
+            # None marks a wiki the API did not return
+            item = shared['Wikis/Details', id]
+            if item is not None:
+                known[str(id)] = item
+        else:
+            found, item = cache.lookup('Wikis/Details', str(id))
+            if found:
+                known[str(id)] = item
+            else:
+                missing.append(id)
+        # Hits come in batches of the same size as the requests
+        if len(known) >= details_batch:
+            yield known
+            known = {}
+    if len(known):
+        yield known
+    
+    # Sorted, so that the batch urls do not depend on the order the ids were
+    # found in and a recorded run can be replayed
+    missing.sort()
+    batches = [missing[i:i + details_batch] for i in range(0, len(missing), details_batch)]
+    batches.reverse()
+    workers = workers or concurrency
+    pending = {}
+    try:
+        while len(batches) or len(pending):
+            while len(batches) and len(pending) < workers:
+                batch = batches.pop()
+                pending[submit('Wikis/Details', {
+                    'ids': ','.join(str(x) for x in batch),
+                    'expand': 1,
+                    'width': 123,
+                    'height': 456,
+                })] = batch
+            done, not_done = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                items = future.result()['items']
+                for id, item in items.items():
+                    cache.store('Wikis/Details', id, item)
+                if shared is not None:
+                    for id in batch:
+                        shared['Wikis/Details', id] = items.get(str(id))
+                yield items
+    finally:
+        for future in pending:
+            future.cancel()
+
+def getDetails(ids, workers = None, batches = False):
+    if batches:
+        return iterDetails(ids, workers)
     res = {}
-    while len(ids):
-        lst = ids[:250]
-        ids = ids[250:]
-        subres = call('Wikis/Details', {
-            'ids': ','.join(str(x) for x in lst),
-            'expand': 1,
-            'width': 123,
-            'height': 456,
-        })
-        res = {**res, **subres['items']}
+    for items in iterDetails(ids, workers):
+        res.update(items)
     return res
 
+def iterWAMIndex(langs = (None,), limit = 20, workers = None):
+    # Yields the ids of the top `limit` wikis of every language as the pages
+    # come in, each id only once
+    pages = -(-limit // wam_page)
+    queue = [(lang, offset) for offset in range(0, pages * wam_page, wam_page) for lang in langs]
+    queue.reverse()
+    workers = workers or concurrency
+    finished = set()
+    seen = set()
+    pending = {}
+    
+    def page(lang, offset, ids):
+        ids = ids[:limit - offset]
+        if len(ids) < wam_page:
+            # Either the language ran out of wikis or this was its last
+            # page, so nothing past this offset is needed
+            finished.add(lang)
+            for other, (l, o) in list(pending.items()):
+                if l == lang and o > offset:
+                    other.cancel()
+                    del pending[other]
+        new = [id for id in ids if id not in seen]
+        seen.update(new)
+        return new
+    
+    try:
+        while len(queue) or len(pending):
+            while len(queue) and len(pending) < workers:
+                lang, offset = queue.pop()
+                if lang in finished:
+                    continue
+                if shared is not None and ('WAM/WAMIndex', lang, offset) in shared:
+                    for id in page(lang, offset, shared['WAM/WAMIndex', lang, offset]):
+                        yield id
+                    continue
+                options = {
+                    'sort_column': 'wam',
+                    'sort_direction': 'DESC',
+                    'limit': wam_page,
+                    'offset': offset,
+                }
+                if lang is not None: options['wiki_lang'] = lang
+                pending[submit('WAM/WAMIndex', options)] = (lang, offset)
+            if len(pending) == 0:
+                continue
+            done, not_done = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                if future not in pending:
+                    continue # Dropped by an earlier page of the same language
+                lang, offset = pending.pop(future)
+                ids = [int(i) for i in future.result()['wam_index'].keys()]
+                if shared is not None:
+                    shared['WAM/WAMIndex', lang, offset] = ids
+                for id in page(lang, offset, ids):
+                    yield id
+    finally:
+        for future in pending:
+            future.cancel()
+
 def getWAMIndex(lang = None, limit = 20):
-    limit = min(limit, 20) # API breaks when limit is above 20 atm
-    lst = []
-    options = {
-        'sort_column': 'wam',
-        'sort_direction': 'DESC',
-        'limit': limit,
-        'offset': 0,
-    }
-    if lang is not None: options['wiki_lang'] = lang
-    while True:
-        res = call('WAM/WAMIndex', options)
-        if len(res['wam_index']) == 0: break
-        lst += [int(i) for i in res['wam_index'].keys()]
-        if len(lst) >= limit: break
-        options['offset'] += options['limit']
-    return lst
\ No newline at end of file
+    return list(iterWAMIndex([lang], limit))
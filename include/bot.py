@@ -6,9 +6,16 @@ from json import loads
 from datetime import datetime, timedelta
 from time import time
 from math import floor
+from copy import deepcopy
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import wait, FIRST_COMPLETED
 
-from include.wiki import newWiki, getCode as getWikiCode, Wiki, InvalidWiki, ClosedWiki, _wikis as allWikis
-from include import api, luad, tools
+from include.wiki import newWiki, normalizeURL, urlDomain, getDomain, Wiki, InvalidWiki, ClosedWiki, _wikis as allWikis
+from include import aliases, api, cache, cassette, datadiff, journal, luadata, manifest, metrics, pool, retry, scheduler, timeseries, tools, window, writer
+
+InvalidRevision = object()
+Unknown = object()
 
 class Bot(pywikibot.bot.SingleSiteBot):
     availableOptions = {
@@ -18,6 +25,20 @@ class Bot(pywikibot.bot.SingleSiteBot):
         'skipadmins': False,
         'skipwam': False,
         'skipqueue': False,
+        'nocache': False,
+        'workers': 1,
+        'rps': None,
+        'hostrps': None,
+        'incremental': False,
+        'budget': None,
+        'requests': None,
+        'slice': None,
+        'resume': False,
+        'report': None,
+        'textdiff': False,
+        'record': None,
+        'replay': None,
+        'realtime': False,
     }
     settings = {
         'languages': None,
@@ -26,6 +47,7 @@ class Bot(pywikibot.bot.SingleSiteBot):
         'image_threshold': 0,
         
         'list_module': 'Wikis/list',
+        'list_shards': None,
         'queue_module': 'Wikis/queue',
         'aliases_module': 'Wikis/aliases',
         'removed_module': 'Wikis/removed',
@@ -42,6 +64,12 @@ class Bot(pywikibot.bot.SingleSiteBot):
         'list_create': 'Bot creates the list of wikis',
         'list_update': 'Bot updates the list of wikis',
         
+        'index_create': 'Bot creates the index of list shards',
+        'index_update': 'Bot updates the index of list shards',
+        
+        'shard_create': 'Bot creates a list shard',
+        'shard_update': 'Bot updates a list shard',
+        
         'wiki_create': 'Bot creates wiki data module',
         'wiki_update': 'Bot updates wiki data module',
         
@@ -55,35 +83,78 @@ class Bot(pywikibot.bot.SingleSiteBot):
         'removed_update': 'Bot updates the list of removals',
     }
     
-    __instance = None
-    def __new__(cls):
-        if cls.__instance is None:
-            cls.__instance = super(Bot, cls).__new__(cls)
-            cls.__instance.__initialized = False
-        return cls.__instance
-        
-    def __init__(self):
-        if(self.__initialized): return
-        self.__initialized = True
-        
+    # Results of per-wiki tasks shared by every Bot of a multi-site cycle,
+    # keyed by (method, id, arguments). See multisite.py
+    shared = None
+    
+    def __init__(self, site = None, args = None):
         start = time()
         
         self.options = {
             'always': False,
             'force': False,
+            'workers': 1,
         }
         
+        # Everything below is per site, several bots can share the process
+        self.settings = dict(self.settings)
+        self._pages = {}
+        self._missing = set()
+        self._invalid = set()
+        self._revisions = {}
+        self._wikitable = set()
+        self.toAdd = set()
+        self.toUpdate = set()
+        self.toRemove = set()
+        self.renamed = set()
+        self.toRefresh = []
+        self.early = {}
+        self.ids = set()
+        self.unresolved = []
+        
         self.args = []
-        for arg in pywikibot.handle_args():
+        for arg in (pywikibot.handle_args() if args is None else args):
             if   arg == '-always':        self.options['always'] = True
             elif arg == '-force':         self.options['force'] = True
             elif arg == '-skipdetails':   self.options['skipdetails'] = True
             elif arg == '-skipadmins':    self.options['skipadmins'] = True
             elif arg == '-skipwam':       self.options['skipwam'] = True
             elif arg == '-skipqueue':     self.options['skipqueue'] = True
+            elif arg == '-nocache':       self.options['nocache'] = True
+            elif arg.startswith('-workers:'): self.options['workers'] = max(1, int(arg[9:]))
+            elif arg.startswith('-rps:'):     self.options['rps'] = float(arg[5:])
+            elif arg.startswith('-hostrps:'): self.options['hostrps'] = float(arg[9:])
+            elif arg == '-incremental':   self.options['incremental'] = True
+            elif arg.startswith('-budget:'):  self.options['budget'] = float(arg[8:])
+            elif arg.startswith('-requests:'): self.options['requests'] = int(arg[10:])
+            elif arg.startswith('-slice:'):   self.options['slice'] = int(arg[7:])
+            elif arg == '-resume':        self.options['resume'] = True
+            elif arg.startswith('-report:'):  self.options['report'] = arg[8:]
+            elif arg == '-textdiff':      self.options['textdiff'] = True
+            elif arg.startswith('-record:'):  self.options['record'] = arg[8:]
+            elif arg.startswith('-replay:'):  self.options['replay'] = arg[8:]
+            elif arg == '-realtime':      self.options['realtime'] = True
             else: self.args.append(arg)
         
-        self._site = pywikibot.Site()
+        cache.enabled = not self.getOption('nocache')
+        pool.global_rps = self.getOption('rps')
+        pool.host_rps = self.getOption('hostrps')
+        
+        self.tape = None
+        if self.getOption('record') or self.getOption('replay'):
+            # Every request has to reach the cassette, so the cache is bypassed
+            self.tape = cassette.Cassette(Path(self.getOption('record') or self.getOption('replay')), 'record' if self.getOption('record') else 'replay', self.getOption('realtime'))
+            pool.tape = self.tape
+            cache.enabled = False
+            if not self.tape.recording and not self.getOption('realtime'):
+                retry.base_delay = retry.max_delay = 0
+        
+        if self.tape is not None and not self.tape.recording:
+            self._site = cassette.ReplaySite(self.tape)
+        else:
+            self._site = site or pywikibot.Site()
+        self.record('meta', 'site', str(self.site))
+        self.record('meta', 'user', self.site.username())
         
         output('\n\r\n\r=== Working on \03{{lightaqua}}{0}\03{{default}} ===\n\r'.format(self.site.sitename, self.site.username()))
         
@@ -111,8 +182,13 @@ class Bot(pywikibot.bot.SingleSiteBot):
             self._current_page = page
             output(u'\n\r\n\r>>> \03{{lightpurple}}{0}\03{{default}} <<<'.format(page.title()))
     
+    def record(self, method, *args):
+        if self.tape is not None and self.tape.recording:
+            getattr(self.tape, method)(*args)
+    
     def getSettings(self):
         title = self._site.mediawiki_message('custom-list-bot-module')
+        self.record('recordMessage', 'custom-list-bot-module', title)
         data = self.getData(title)
         
         for key in ['languages', 'remove_keys']:
@@ -127,40 +203,173 @@ class Bot(pywikibot.bot.SingleSiteBot):
             self.settings[key + '_threshold'] = data.get('thresholds', {}).get('list_' + key + 's', self.settings[key + '_threshold'])
         
         for key in ['list', 'queue', 'aliases', 'removed']:
-            self.settings[key + '_module'] =  pywikibot.page.Page(self.site, data.get('modules', {}).get(key, self.settings[key + '_module']), ns = 828)
+            self.settings[key + '_module'] = self.getPage(data.get('modules', {}).get(key, self.settings[key + '_module']))
+        
+        # Either 'language' or the width of the id range kept in one shard
+        shards = data.get('list_shards', self.settings['list_shards'])
+        if isinstance(shards, int) and not isinstance(shards, bool):
+            shards = max(1, shards)
+        elif shards != 'language':
+            shards = None
+        self.settings['list_shards'] = shards
         
     # Lua data
+    history_batch = 10
+    preload_batch = 50
+    
+    def getPage(self, name):
+        if isinstance(name, (pywikibot.page.Page, cassette.ReplayPage)):
+            return name
+        if self.tape is not None and not self.tape.recording:
+            page = cassette.ReplayPage(self.site, name, ns = 828)
+        else:
+            page = pywikibot.page.Page(self.site, name, ns = 828)
+            self.record('recordTitle', name, page.title())
+        return self._pages.setdefault(page.title(), page)
+    
+    def preloadPages(self, pages):
+        pages = list(pages)
+        output('Preloading {:d} page(s)'.format(len(pages)))
+        start = time()
+        for page in self.site.preloadpages(pages, groupsize = self.preload_batch):
+            pass
+        metrics.current.page('preload', time() - start)
+        for page in pages:
+            self.record('recordPage', page)
+            if not page.exists():
+                self._missing.add(page.title())
+    
+    def parseRevision(self, revid, text):
+        try:
+            data = self._revisions[revid]
+        except KeyError:
+            try:
+                data = luadata.loads(text)
+            except Exception:
+                data = InvalidRevision
+            self._revisions[revid] = data
+        if data is InvalidRevision:
+            raise ValueError('Invalid Lua code in revision #{:d}'.format(revid))
+        return deepcopy(data)
+    
+    def olderRevisions(self, page, revid):
+        while True:
+            start = time()
+            self.site.loadrevisions(page, content = True, startid = revid, total = self.history_batch + 1)
+            metrics.current.page('history', time() - start)
+            self.record('recordRevisions', page)
+            revs = sorted([rev for rev in page._revisions.values() if rev.revid < revid], key = lambda rev: rev.revid, reverse = True)[:self.history_batch]
+            if len(revs) == 0:
+                return
+            for rev in revs:
+                yield rev
+            revid = revs[-1].revid
+    
     def getData(self, name):
-        page = name if isinstance(name, pywikibot.page.Page) else pywikibot.page.Page(self.site, name, ns = 828)
+        page = self.getPage(name)
+        if page.title() in self._missing:
+            return None
         
+        start = time()
         try:
-            history = page.getVersionHistory(forceReload = True, getAll = True)
+            text = page.get(get_redirect = True)
         except pywikibot.exceptions.NoPage:
+            self.record('recordPage', page, time() - start)
             return None
+        revid = page.latest_revision_id
+        metrics.current.page('read', time() - start, len(text))
+        self.record('recordPage', page, time() - start)
+        
+        try:
+            return self.parseRevision(revid, text)
+        except ValueError:
+            output('Skipping revision #{0:d} - invalid Lua code'.format(revid))
+        # Whatever an older revision holds, the page itself has to be rewritten
+        self._invalid.add(page.title())
         
-        for rev in history:
-            text = page.getOldVersion(rev.revid)
+        for rev in self.olderRevisions(page, revid):
             try:
-                return luad.loads(text)
-            except Exception:
+                return self.parseRevision(rev.revid, rev.text)
+            except ValueError:
                 output('Skipping revision #{0.revid:d} by {0.user:s} - invalid Lua code'.format(rev))
         return None
         
-    def saveData(self, name, data, summary = None, summary_key = None, **kwargs):
-        page = self.current_page = name if isinstance(name, pywikibot.page.Page) else pywikibot.page.Page(self.site, name, ns = 828)
+    _manifest = None
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = manifest.forSite(self.site)
+        return self._manifest
+    
+    _saved_lock = Lock()
+    def skipUnchanged(self, page, exists, digest):
+        with self._saved_lock:
+            if exists:
+                self.manifest.record(page.title(), digest, page.latest_revision_id)
+            self.journal.markSaved(page.title())
+        output('No changes')
+    
+    _writer = None
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = writer.Writer()
+        return self._writer
+    
+    def pageSaved(self, digest):
+        # Runs on the writer thread once the edit went through
+        def callback(page, text, seconds):
+            metrics.current.page('write', seconds, len(text))
+            self.record('recordWrite', page.title(), seconds)
+            with self._saved_lock:
+                self._missing.discard(page.title())
+                self._invalid.discard(page.title())
+                self.manifest.record(page.title(), digest, page.latest_revision_id)
+                self.journal.markSaved(page.title())
+        return callback
+    
+    def flushWrites(self):
+        errors = self.writer.flush()
+        for page, error in errors:
+            output('\03{{lightred}}Could not save {}\03{{default}}: {}'.format(page.title(), error))
+        return errors
+    
+    def saveData(self, name, data, summary = None, summary_key = None, old = Unknown, **kwargs):
+        page = self.current_page = self.getPage(name)
         
-        summary = summary or self.summaries.get(summary_key, self.summaries['default'])
+        if page.title() in self.journal.saved:
+            return output('Already saved before resuming')
         
-        newtext = 'return ' + luad.dumps(data, indent = 4)
-        try:
-            oldtext = page.get()
-        except pywikibot.exceptions.NoPage:
-            oldtext = ''
+        summary = summary or self.summaries.get(summary_key, self.summaries['default'])
         
-        if re.sub('\[\'updated_timestamp\'\]\s*=\s*\d+,', '', newtext) == re.sub('\[\'updated_timestamp\'\]\s*=\s*\d+,', '', oldtext):
-            return output('No changes')
+        digest = manifest.payloadHash(data)
+        exists = page.title() not in self._missing and page.exists()
+        if page.title() in self._invalid:
+            old = Unknown # Compare with the broken text, so that it gets replaced
+        elif exists and not self.getOption('force') and self.manifest.matches(page.title(), digest, page.latest_revision_id):
+            return self.skipUnchanged(page, exists, digest)
         
-        pywikibot.showDiff(oldtext, newtext)
+        if old is Unknown or self.getOption('textdiff'):
+            newtext = 'return ' + luadata.dumps(data, indent = 4)
+            try:
+                if page.title() in self._missing:
+                    raise pywikibot.exceptions.NoPage(page)
+                oldtext = page.get()
+            except pywikibot.exceptions.NoPage:
+                oldtext = ''
+            
+            if re.sub('\[\'updated_timestamp\'\]\s*=\s*\d+,', '', newtext) == re.sub('\[\'updated_timestamp\'\]\s*=\s*\d+,', '', oldtext):
+                return self.skipUnchanged(page, exists, digest)
+            
+            pywikibot.showDiff(oldtext, newtext)
+        else:
+            changes = list(datadiff.diff(old, data, ignore = ('updated_timestamp',)))
+            if len(changes) == 0:
+                return self.skipUnchanged(page, exists, digest)
+            
+            for line in datadiff.summarize(changes):
+                output(line)
+            newtext = None
         output('Summary: {}'.format(summary))
         
         if self.getOption('always'):
@@ -172,11 +381,12 @@ class Bot(pywikibot.bot.SingleSiteBot):
             self.options['always'] = True
             choice = 'y'
         if choice == 'y':
-            page.put(newtext, summary, **kwargs)
+            if newtext is None:
+                newtext = 'return ' + luadata.dumps(data, indent = 4)
+            self.writer.put(page, newtext, summary, self.pageSaved(digest), **kwargs)
     
     
     # Wiki table
-    _wikitable = set()
     def addToTable(self, color, id, wiki):
         self._wikitable.add((id, color, wiki))
     def printLogTable(self):
@@ -207,16 +417,39 @@ class Bot(pywikibot.bot.SingleSiteBot):
     @property
     def wikidata(self):
         if self._wikidata is None:
-            data = self.getData('Module:Lista/wiki')
+            data = self.getData(self.settings['list_module'])
             if isinstance(data, tuple):
                 data = data[0]
-            if isinstance(data, dict) and 'wikis' in data:
+            if isinstance(data, dict) and 'shards' in data:
+                self._wikidata = {}
+                pages = [self.shardPage(name) for name in data['shards']]
+                self.preloadPages(pages)
+                for page in pages:
+                    shard = self.getData(page)
+                    if isinstance(shard, dict) and 'wikis' in shard:
+                        self._wikidata.update(shard['wikis'])
+            elif isinstance(data, dict) and 'wikis' in data:
                 self._wikidata = data['wikis']
             else:
                 self._wikidata = {}
         return self._wikidata
     
+    def shardName(self, id, wiki):
+        if self.settings['list_shards'] == 'language':
+            return wiki.get('language') or 'other'
+        size = self.settings['list_shards']
+        start = id // size * size
+        return '{:d}-{:d}'.format(start, start + size - 1)
+    
+    def shardPage(self, name):
+        return self.getPage('{}/{}'.format(self.settings['list_module'].title(with_ns = False), name))
+    
     def getCurrentWikis(self):
+        # The registry may still hold the list and the admins of a site run
+        # before this one
+        for wiki in allWikis.values():
+            wiki.onList = False
+            wiki.clearAdmins()
         lst = [int(i) for i in self.wikidata]
         for id in lst:
             wiki = Wiki(id)
@@ -225,12 +458,7 @@ class Bot(pywikibot.bot.SingleSiteBot):
         return lst
         
     def getWAMWikis(self):
-        if self.settings['languages'] is None:
-            return api.getWAMIndex()
-        res = []
-        for lang in self.settings['languages']:
-            res += api.getWAMIndex(lang)
-        return res
+        return list(api.iterWAMIndex(self.settings['languages'] or [None]))
     
     def getQueuedWikis(self):
         lst = []
@@ -244,35 +472,145 @@ class Bot(pywikibot.bot.SingleSiteBot):
         except TypeError:
             pass
         
-        total = len(lst2)
-        if total > 0:
-            output('Found {} urls in the queue.'.format(total))
-            i = 0
-            tools.progressBar(0, 'Progress (0/{})'.format(total))
-            try:
-                for url in lst2:
-                    data = api.getWikiVariables(url)
-                    lst += [int(data['id'])]
-                    i += 1
-                    tools.progressBar(i/total, 'Progress ({}/{})'.format(i, total))
-            finally:
-                print()
+        if len(lst2) > 0:
+            output('Found {} urls in the queue.'.format(len(lst2)))
+            lst += self.resolveURLs(lst2)
         
         #lst += [3, 4, 1407124, 12345, 652632, 1743907, 1,2,3,4,5,6,7,8,9]
         # TODO: stare metody
         return lst
     
+    _aliases = None
+    @property
+    def aliases(self):
+        if self._aliases is None:
+            index = aliases.forSite(self.site)
+            page = self.settings['aliases_module']
+            exists = page.title() not in self._missing and page.exists()
+            if not exists or not self.manifest.matches(page.title(), index.digest(), page.latest_revision_id):
+                # Missing, or edited by somebody else since the bot saved it
+                index.rebuild(self.getData(page) if exists else None, self.wikidata)
+                for id, wiki in self.wikidata.items():
+                    index.add(wiki['code'], id)
+            self._aliases = index
+        return self._aliases
+    
+    _listCodes = None
+    def lookupCode(self, code):
+        id = self.aliases.lookup(code)
+        if id is None:
+            if self._listCodes is None:
+                self._listCodes = {wiki['code'].lower(): int(id) for id, wiki in self.wikidata.items() if wiki.get('code')}
+            id = self._listCodes.get(code)
+        return id
+    
+    def resolveURLs(self, urls):
+        # Known wikis are looked up in the aliases and the current list, the
+        # rest goes to WikiVariables once per code. Urls of wikis that do not
+        # exist are remembered for a while instead of being retried, the ones
+        # that failed otherwise stay in the queue
+        ids = []
+        queue = {}
+        for url in urls:
+            code = normalizeURL(url)
+            id = self.lookupCode(code)
+            if id is not None:
+                ids.append(id)
+                continue
+            found, reason = cache.lookup('Queue/Unresolved', code)
+            if found:
+                output('Skipping {} - could not be resolved recently ({})'.format(url, reason))
+                continue
+            queue.setdefault(code, []).append(url)
+        
+        total = len(queue)
+        if total == 0:
+            return ids
+        
+        output('Resolving {:d} url(s)'.format(total))
+        i = 0
+        tools.progressBar(0, 'Progress (0/{})'.format(total))
+        lst = list(queue)
+        lst.reverse()
+        pending = {}
+        try:
+            while len(lst) or len(pending):
+                while len(lst) and len(pending) < api.concurrency:
+                    code = lst.pop()
+                    # The code only merges the urls, the request goes to the
+                    # host they were queued with, e.g. foo.wikia.org
+                    pending[api.submitWikiVariables(getDomain(urlDomain(queue[code][0])))] = code
+                finished, unfinished = wait(pending, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    code = pending.pop(future)
+                    try:
+                        ids.append(int(future.result()['id']))
+                    except Exception as e:
+                        if api.notFound(e):
+                            cache.store('Queue/Unresolved', code, str(e))
+                            output('\n\rCould not resolve {}: {}'.format(', '.join(queue[code]), e))
+                        else:
+                            self.unresolved += queue[code]
+                            output('\n\rCould not resolve {} for now, keeping it in the queue: {}'.format(', '.join(queue[code]), e))
+                    i += 1
+                    tools.progressBar(i/total, 'Progress ({}/{})'.format(i, total))
+        finally:
+            for future in pending:
+                future.cancel()
+            print()
+        return ids
+    
+    _journal = None
+    @property
+    def journal(self):
+        if self._journal is None:
+            self._journal = journal.forSite(self.site)
+        return self._journal
+    
+    def startJournal(self):
+        if self.getOption('resume'):
+            if self.journal.exists():
+                self.journal.load()
+                self._time = self.journal.time
+                output('Resuming run from \03{{lightaqua}}{}\03{{default}}: {:d} checkpoint(s), {:d} saved page(s)'.format(datetime.fromtimestamp(self.time), sum(len(x) for x in self.journal.done.values()), len(self.journal.saved)))
+                return
+            output('\03{lightyellow}No interrupted run to resume, starting over\03{default}')
+        self.journal.start(self.time)
+    
     def run(self):
         start = time()
         
-        self.step1()
-        self.step2()
-        
-        self.step3()
-        self.end()
+        try:
+            self.startJournal()
+            self.step1()
+            self.step2()
+            
+            always = self.getOption('always')
+            self.step3()
+            self.end()
+            if always:
+                self.measureCost()
+            self.journal.finish()
+        finally:
+            self.stopEarly()
+            self.writeReport()
         
+        for ns, counts in cache.getCache().stats().items():
+            output('  Cache {}: {:d} hit(s), {:d} miss(es)'.format(ns, counts['hits'], counts['misses']))
         output('\n  Run time: {:.2f}s'.format(time() - start))
     
+    def writeReport(self):
+        path = self.getOption('report') or tools.siteFile('reports', self.site, '-{:d}.json'.format(self.time))
+        metrics.current.write(path, site = str(self.site), options = self.options, wikis = {
+            'total': len(self.ids),
+            'added': len(self.toAdd),
+            'updated': len(self.toUpdate),
+            'removed': len(self.toRemove),
+            'refreshed': len(self.toRefresh),
+        })
+        output('  Run report: {}'.format(path))
+    
+    @metrics.timed
     def step1(self):
         output('\n\r\03{lightyellow}Step 1\03{default}: Grabbing lists')
         
@@ -306,63 +644,202 @@ class Bot(pywikibot.bot.SingleSiteBot):
         
         for id in ids:
             Wiki(id)
+        self.ids = ids
     
-    
-    toAdd = set()
-    toUpdate = set()
-    toRemove = set()
+    @metrics.timed
     def step2(self):
         output('\n\r\03{lightyellow}Step 2\03{default}: Fetching base info and processing')
         
-        ids = [id for id in allWikis]
-        lst = api.getDetails(ids)
+        ids = [id for id in allWikis if id in self.ids]
+        found = set()
+        
+        # Wikis are classified batch by batch as Details responses come in
+        for items in api.getDetails(ids, batches = True):
+            for id, item in items.items():
+                wiki = Wiki(int(id))
+                wiki.updateFromAPI(item)
+                found.add(wiki.id)
+                self.classify(wiki)
         
         for id in ids:
-            wiki = Wiki(id)
-            try:
-                wiki.updateFromAPI(lst[str(id)])
-            except KeyError:
+            if id not in found:
+                wiki = Wiki(id)
                 wiki.__class__ = ClosedWiki if wiki.onList else InvalidWiki
-            
-            if isinstance(wiki, ClosedWiki):
-                if wiki.onList:
-                    self.toRemove.add(wiki)
-                wiki.status = 'closed'
-                self.addToTable('lightred', id, wiki)
-            elif isinstance(wiki, InvalidWiki):
-                wiki.status = 'invalid'
-                self.addToTable('gray', id, wiki)
-            elif self.settings['languages'] is not None and wiki.language not in self.settings['languages']:
-                if wiki.onList:
-                    self.toRemove.add(wiki)
-                wiki.status = 'badlang'
-                self.addToTable('lightpurple', id, wiki)
-            elif not wiki.onList:
-                self.toAdd.add(wiki)
-                wiki.status = 'new'
-                self.addToTable('lightgreen', id, wiki)
-            else:
-                self.toUpdate.add(wiki)
-                wiki.status = ' '
-                self.addToTable('default', id, wiki)
+                self.classify(wiki)
         
         self.printLogTable()
+        self.scheduleRefresh()
+    
+    def classify(self, wiki):
+        id = wiki.id
+        if isinstance(wiki, ClosedWiki):
+            if wiki.onList:
+                self.toRemove.add(wiki)
+            wiki.status = 'closed'
+            wiki.bury()
+            self.addToTable('lightred', id, wiki)
+        elif isinstance(wiki, InvalidWiki):
+            wiki.status = 'invalid'
+            wiki.bury()
+            self.addToTable('gray', id, wiki)
+        elif self.settings['languages'] is not None and wiki.language not in self.settings['languages']:
+            if wiki.onList:
+                self.toRemove.add(wiki)
+            wiki.status = 'badlang'
+            self.addToTable('lightpurple', id, wiki)
+        elif not wiki.onList:
+            self.toAdd.add(wiki)
+            wiki.status = 'new'
+            self.addToTable('lightgreen', id, wiki)
+            self.startEarly(wiki)
+        else:
+            self.toUpdate.add(wiki)
+            wiki.status = ' '
+            self.addToTable('default', id, wiki)
+            self.startEarly(wiki)
+    
+    _tasks = None
+    @property
+    def tasks(self):
+        # Per-wiki tasks, -workers of them at a time
+        if self._tasks is None:
+            self._tasks = window.Window(self.getOption('workers'))
+        return self._tasks
+    
+    prefetch_limit = 4 # WikiVariables prefetches in flight, more would hold up the Details batches
+    _prefetches = None
+    @property
+    def prefetches(self):
+        if self._prefetches is None:
+            self._prefetches = window.Window(self.prefetch_limit)
+        return self._prefetches
+    
+    def startEarly(self, wiki):
+        # Without -incremental every kept wiki is refreshed, so its requests
+        # can start while the remaining Details batches are still coming in
+        if self.getOption('incremental'):
+            return
+        if not self.getOption('skipdetails') and not wiki.has_details:
+            self.early[('getWikiVariables', wiki.id)] = self.prefetches.submit(lambda waiting: wiki.submitWikiVariables())
+        args = (timedelta(days = self.settings['active_days']),)
+        if not self.getOption('skipadmins') and wiki.id not in self.journal.done['getAdminCount'] and self.sharedResult(wiki, 'getAdminCount', args) is None:
+            self.early[('getAdminCount', wiki.id)] = self.submitTask(wiki, 'getAdminCount', *args)
+    
+    def stopEarly(self):
+        if self._prefetches is not None:
+            self._prefetches.clear()
+        if self._tasks is not None:
+            self._tasks.clear()
+        early, self.early = self.early, {}
+        for future in early.values():
+            future.cancel()
+    
+    def measureCost(self):
+        # Only the per-wiki work counts, the admin counts run -workers at a
+        # time and the saves one by one. Runs without -always are not
+        # measured, the save timings would include the prompts
+        tasks = metrics.current.tasks
+        seconds = tasks['getAdminCount'].total / self.getOption('workers') + tasks['save'].total
+        self.scheduler.measure(len(self.toRefresh), seconds)
+    
+    _scheduler = None
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = scheduler.forSite(self.site)
+        return self._scheduler
+    
+    def scheduleRefresh(self):
+        wikis = self.toAdd | self.toUpdate
+        if not self.getOption('incremental'):
+            self.toRefresh = sorted(wikis, key = lambda wiki: wiki.id)
+            return
+        
+        entries = []
+        for wiki in wikis:
+            old = self.wikidata.get(wiki.id, {})
+            saved = self.manifest.get(self.wikiPage(wiki.id).title())
+            if wiki in self.toAdd:
+                tier = 0
+            elif old.get('code') != wiki.code:
+                tier = 1
+            else:
+                tier = 2
+            entries.append((wiki, tier, saved and saved['timestamp'], old.get('stats')))
+        
+        capacity = self.scheduler.capacity(self.getOption('budget'), self.getOption('requests'), self.getOption('slice'))
+        self.toRefresh = self.scheduler.select(entries, capacity)
+        output('Incremental mode: refreshing \03{{lightaqua}}{:d}\03{{default}} of {:d} wiki(s)'.format(len(self.toRefresh), len(wikis)))
     
     def runForAll(self, method, *args, **kwargs):
-        lst = sorted([(wiki.id, wiki) for wiki in self.toAdd | self.toUpdate])
+        done = self.journal.done[method]
+        lst = []
+        for wiki in self.toRefresh:
+            if wiki.id in done:
+                wiki.restore(method, done[wiki.id])
+                continue
+            data = self.sharedResult(wiki, method, args, kwargs)
+            if data is not None:
+                # Already done for another site in this cycle
+                wiki.restore(method, data)
+                self.journal.checkpoint(method, wiki.id, data)
+            else:
+                lst.append((wiki.id, wiki))
         
-        total = len(lst)
-        i = 0
+        total = len(self.toRefresh)
+        i = total - len(lst)
         print()
         tools.progressBar(0, 'Progress (0/{})'.format(total))
+        
+        pending = {}
         try:
+            # The task window keeps -workers of them going
             for id, wiki in lst:
-                getattr(wiki, method)(*args, **kwargs)
-                i += 1
-                tools.progressBar(i/total, 'Progress ({}/{})'.format(i, total))
+                future = self.early.pop((method, id), None) or self.submitTask(wiki, method, *args, **kwargs)
+                pending[future] = wiki
+            while len(pending):
+                finished, unfinished = wait(pending, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    wiki = pending.pop(future)
+                    try:
+                        data = future.result()
+                    except api.JSONError as e:
+                        output('\n\rSkipping {}: {}'.format(wiki.domain, e))
+                    else:
+                        # Only applied here, so tasks still running after an
+                        # interrupt cannot change the wiki any more
+                        wiki.restore(method, data)
+                        self.journal.checkpoint(method, wiki.id, data)
+                        if self.shared is not None:
+                            self.shared[self.sharedKey(wiki, method, args, kwargs)] = data
+                    i += 1
+                    tools.progressBar(i/total, 'Progress ({}/{})'.format(i, total))
         finally:
+            for future in pending:
+                future.cancel()
+            for key in [key for key in self.early if key[0] == method]:
+                self.early.pop(key).cancel()
             print()
     
+    def sharedKey(self, wiki, method, args, kwargs = {}):
+        return (method, wiki.id, tuple(args), tuple(sorted(kwargs.items())))
+    
+    def sharedResult(self, wiki, method, args, kwargs = {}):
+        if self.shared is None:
+            return None
+        return self.shared.get(self.sharedKey(wiki, method, args, kwargs))
+    
+    def submitTask(self, wiki, method, *args, **kwargs):
+        # Runs the asynchronous variant of a Wiki method, submitX for getX,
+        # once the task window has room for it
+        def start(waiting):
+            begin = time()
+            future = getattr(wiki, 'submit' + method[3:])(*args, waiting = waiting, **kwargs)
+            future.add_done_callback(lambda future: metrics.current.wiki(wiki, method, time() - begin))
+            return future
+        return self.tasks.submit(start)
+    
+    @metrics.timed
     def step3(self):
         output('\n\r\03{lightyellow}Step 3\03{default}: Active admin counts')
         
@@ -376,11 +853,12 @@ class Bot(pywikibot.bot.SingleSiteBot):
             output('\n\r\03{lightblue}Task was finished partially.\03{default}')
             choice = pywikibot.input_choice('Do you want to keep partial data on save or ignore it?', [('Keep', 'k'), ('Ignore', 'i')], default='k')
             if choice == 'i':
-                for wiki in self.toAdd | self.toUpdate:
-                    wiki.dumpAdminCount = False
+                for wiki in self.toRefresh:
+                    wiki.clearAdmins()
             elif choice == 'q':
                 raise pywikibot.bot.QuitKeyboardInterrupt
     
+    @metrics.timed
     def saveList(self):
         self.current_page = self.settings['list_module']
         
@@ -391,6 +869,8 @@ class Bot(pywikibot.bot.SingleSiteBot):
             self.wikidata[wiki.id] = wiki.dump()
         
         for wiki in self.toUpdate:
+            if self.wikidata[wiki.id].get('code') != wiki.code:
+                self.renamed.add(wiki)
             dump = wiki.dump()
                         
             for key, value in dump.items():
@@ -411,38 +891,67 @@ class Bot(pywikibot.bot.SingleSiteBot):
             except TypeError:
                 pass
         
-        self.saveData(self.settings['list_module'], { 'wikis': self.wikidata, 'updated_timestamp': self.time}, summary_key = 'list_update' if self.settings['list_module'].exists() else 'list_create')
+        if self.settings['list_shards'] is not None:
+            return self.saveShards()
         
+        self.saveData(self.settings['list_module'], { 'wikis': self.wikidata, 'updated_timestamp': self.time}, summary_key = 'list_update' if self.settings['list_module'].exists() else 'list_create', old = self.getData(self.settings['list_module']))
     
+    def saveShards(self):
+        shards = {}
+        for id, wiki in self.wikidata.items():
+            shards.setdefault(self.shardName(id, wiki), {})[id] = wiki
+        
+        index = self.getData(self.settings['list_module'])
+        previous = index.get('shards', {}) if isinstance(index, dict) else {}
+        
+        # Shards that became empty are cleared rather than left with stale entries
+        pages = {name: self.shardPage(name) for name in set(shards) | set(previous)}
+        self.preloadPages(pages.values())
+        
+        for name in sorted(pages):
+            page = pages[name]
+            if name not in shards and page.title() in self._missing:
+                continue
+            self.saveData(page, { 'wikis': shards.get(name, {}), 'updated_timestamp': self.time}, summary_key = 'shard_update' if page.exists() else 'shard_create', old = self.getData(page))
+        
+        data = {
+            'by': 'language',
+            'shards': {name: {'module': pages[name].title(), 'count': len(shards[name])} for name in shards},
+            'updated_timestamp': self.time,
+        }
+        if self.settings['list_shards'] != 'language':
+            data['by'] = 'id'
+            data['size'] = self.settings['list_shards']
+        self.saveData(self.settings['list_module'], data, summary_key = 'index_update' if self.settings['list_module'].exists() else 'index_create', old = index)
+        
+    
+    @metrics.timed
     def saveQueue(self):
         self.current_page = self.settings['queue_module']
         
-        self.saveData(self.settings['queue_module'], [], summary_key = 'queue_update' if self.settings['queue_module'].exists() else 'queue_create')
+        self.saveData(self.settings['queue_module'], self.unresolved, summary_key = 'queue_update' if self.settings['queue_module'].exists() else 'queue_create', old = self.getData(self.settings['queue_module']))
     
+    @metrics.timed
     def saveAliases(self):
         self.current_page = self.settings['aliases_module']
         
-        data = self.getData(self.settings['aliases_module']) or {}
+        index = self.aliases
+        old = index.source if index.rebuilt else dict(index.codes)
         
-        for alias in list(data.keys()):
-            if data[alias] not in self.wikidata:
-                del data[alias]
-                continue
-            
-            code = getWikiCode(alias)
-            if alias != code:
-                data[code] = data[alias]
-                del data[alias]
-            
-        for id in self.wikidata:
-            data[self.wikidata[id]['code']] = id
+        for wiki in self.toRemove:
+            index.remove(wiki.id)
+        for wiki in self.toAdd | self.renamed:
+            index.add(wiki.code, wiki.id)
+        index.save()
         
-        self.saveData(self.settings['aliases_module'], data, summary_key = 'aliases_update' if self.settings['aliases_module'].exists() else 'aliases_create')
+        self.saveData(self.settings['aliases_module'], dict(index.codes), summary_key = 'aliases_update' if self.settings['aliases_module'].exists() else 'aliases_create', old = old)
     
+    @metrics.timed
     def saveRemoved(self):
         self.current_page = self.settings['removed_module']
         
-        data = self.getData(self.settings['removed_module']) or {}
+        old = self.getData(self.settings['removed_module'])
+        data = deepcopy(old) or {}
         
         for wiki in self.toRemove:
             if wiki.id not in data:
@@ -453,27 +962,71 @@ class Bot(pywikibot.bot.SingleSiteBot):
                     'reason': wiki.status
                 }
         
-        self.saveData(self.settings['removed_module'], data, summary_key = 'removed_update' if self.settings['removed_module'].exists() else 'removed_create')
+        self.saveData(self.settings['removed_module'], data, summary_key = 'removed_update' if self.settings['removed_module'].exists() else 'removed_create', old = old)
 
+    _series = None
+    @property
+    def series(self):
+        if self._series is None:
+            self._series = timeseries.forSite(self.site)
+        return self._series
+    
+    def wikiPage(self, id):
+        return self.getPage('{}/{}'.format(self.settings['list_module'].title(with_ns = False), id))
+    
+    @metrics.timed
     def saveWikis(self):
-        tpl = '{}/{{}}'.format(self.settings['list_module'].title(with_ns = False))
-        wikis = sorted([(wiki.id, wiki) for wiki in self.toAdd | self.toUpdate])
+        wikis = [(wiki.id, wiki) for wiki in self.toRefresh if self.wikiPage(wiki.id).title() not in self.journal.saved]
+        
+        pages = {id: self.wikiPage(id) for id, wiki in wikis}
+        self.preloadPages(pages.values())
+        
+        failed = set()
+        if not self.getOption('skipdetails'):
+            # Prefetches started in step 2 may still be running, the ones
+            # still waiting for their turn are submitted right away
+            if self._prefetches is not None:
+                self._prefetches.clear()
+            futures = []
+            for id, wiki in wikis:
+                if not wiki.has_details:
+                    future = self.early.pop(('getWikiVariables', id), None)
+                    futures.append((wiki, future if future is not None and not future.cancelled() else wiki.submitWikiVariables()))
+            for wiki, future in futures:
+                try:
+                    future.result()
+                except api.JSONError as e:
+                    output('\n\rSkipping {}: {}'.format(wiki.domain, e))
+                    failed.add(wiki.id)
         
         i = 0
         total = len(wikis)
         for id, wiki in wikis:
-            page = pywikibot.page.Page(self.site, tpl.format(id), ns = 828)
+            if id in failed:
+                continue
+            start = time()
+            page = pages[id]
             self.current_page = page
             
-            data = self.getData(page) or {}
+            old = self.getData(page)
+            data = deepcopy(old) or {}
             data['updated_timestamp'] = self.time
             
-            try:
-                stats = data['stats'].copy()
-            except KeyError:
-                stats = {}
+            # History kept in the module seeds the local store the first time
+            if not self.series.has(id) and isinstance(data.get('stats'), dict):
+                for day, values in sorted(data['stats'].items()):
+                    try:
+                        self.series.append(id, day, values)
+                    except (ValueError, TypeError, AttributeError):
+                        pass # Not a YYYY-MM-DD entry
             
-            dump = wiki.dump(True, not self.getOption('skipdetails'))
+            try:
+                dump = wiki.dump(True, not self.getOption('skipdetails'))
+            except api.JSONError as e:
+                output('\n\rSkipping {}: {}'.format(wiki.domain, e))
+                continue
+            for day, values in dump.pop('stats').items():
+                self.series.append(id, day, values)
             
             for key, value in dump.items():
                 if isinstance(value, dict):
@@ -484,7 +1037,7 @@ class Bot(pywikibot.bot.SingleSiteBot):
                 else:
                     data[key] = dump[key]
             
-            data['stats'] = {key: {**stats.get(key, {}), **data['stats'][key]} for key in sorted(data['stats'].keys())[-self.settings['keep_days']:]}
+            data['stats'] = self.series.window(id, self.settings['keep_days'])
             
             try:
                 for key in self.settings['remove_keys']:
@@ -495,12 +1048,14 @@ class Bot(pywikibot.bot.SingleSiteBot):
             except TypeError:
                 pass
             
-            self.saveData(page, data, summary_key = 'wiki_update' if self.settings['removed_module'].exists() else 'wiki_create')
+            self.saveData(page, data, summary_key = 'wiki_update' if page.exists() else 'wiki_create', old = old)
+            metrics.current.wiki(wiki, 'save', time() - start)
             
             i += 1
             output('Finished {} out of {} ({:.1%})'.format(i, total, i/total))
         
     
+    @metrics.timed
     def end(self):
         output('\n\r\03{lightyellow}Last step\03{default}: Saving data')
         
@@ -508,4 +1063,9 @@ class Bot(pywikibot.bot.SingleSiteBot):
         self.saveQueue()
         self.saveAliases()
         self.saveRemoved()
-        self.saveWikis()
\ No newline at end of file
+        self.saveWikis()
+        
+        output('\n\rWaiting for pending edits')
+        self.flushWrites()
+        self.manifest.save()
+        self.series.flush()
\ No newline at end of file
@@ -0,0 +1,132 @@
+# -*- coding: utf-8  -*-
+
+import sqlite3, json, threading, time, atexit
+from collections import defaultdict
+
+from include import tools
+
+enabled = True
+filename = 'cache.sqlite3'
+max_entries = 200000
+busy_timeout = 30000 # ms to wait for another process holding the write lock
+
+default_ttl = 3600
+ttls = {
+    'include.api.getWikiVariables': 24 * 3600,
+    'Wikis/Details': 6 * 3600,
+    'Queue/Unresolved': 3 * 24 * 3600,
+}
+
+class Cache:
+    def __init__(self, path, max_entries = max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._db = None
+        self._lock = threading.RLock()
+        self._writes = 0
+        self._accessed = {} # (ns, key) -> time of hits not written yet
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(str(self.path), check_same_thread = False)
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            self._db.execute('PRAGMA busy_timeout = {:d}'.format(busy_timeout))
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries (ns TEXT, key TEXT, value TEXT, expires REAL, accessed REAL, PRIMARY KEY (ns, key))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        return self._db
+
+    def get(self, ns, key):
+        now = time.time()
+        with self._lock:
+            row = self.db.execute('SELECT value, expires FROM entries WHERE ns = ? AND key = ?', (ns, key)).fetchone()
+            if row is None or row[1] < now:
+                self.misses[ns] += 1
+                return False, None
+            # Written with the next commit, a hit must not hold the write lock
+            self._accessed[(ns, key)] = now
+            self.hits[ns] += 1
+            if len(self._accessed) >= 1000:
+                self.commit()
+        return True, json.loads(row[0])
+
+    def set(self, ns, key, value, ttl = None):
+        now = time.time()
+        if ttl is None:
+            ttl = ttls.get(ns, default_ttl)
+        with self._lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (ns, key, json.dumps(value), now + ttl, now))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self.evict()
+            else:
+                self.commit()
+
+    def commit(self):
+        # Every write is committed right away, so that other processes using
+        # the same file are not locked out
+        with self._lock:
+            if len(self._accessed):
+                accessed, self._accessed = self._accessed, {}
+                self.db.executemany('UPDATE entries SET accessed = ? WHERE ns = ? AND key = ?', [(at, ns, key) for (ns, key), at in accessed.items()])
+            self.db.commit()
+
+    def evict(self):
+        with self._lock:
+            self.db.execute('DELETE FROM entries WHERE expires < ?', (time.time(),))
+            count = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute('DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY accessed LIMIT ?)', (count - self.max_entries,))
+            self.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self.commit()
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        return {ns: {'hits': self.hits[ns], 'misses': self.misses[ns]} for ns in sorted(set(self.hits) | set(self.misses))}
+
+__cache = None
+def getCache():
+    global __cache
+    if __cache is None:
+        __cache = Cache(tools.dataFile(filename))
+        atexit.register(__cache.close)
+    return __cache
+
+def makeKey(args, kwargs = {}):
+    return json.dumps([list(args), sorted(kwargs.items())], sort_keys = True)
+
+def lookup(ns, key):
+    if not enabled:
+        return False, None
+    return getCache().get(ns, key)
+
+def store(ns, key, value, ttl = None):
+    if enabled:
+        getCache().set(ns, key, value, ttl)
+
+def cached(fn = None, ttl = None):
+    if fn is None:
+        return lambda fn: cached(fn, ttl)
+
+    name = fn.__module__ + '.' + fn.__name__
+
+    def decorator(*args, **kwargs):
+        key = makeKey(args, kwargs)
+        found, data = lookup(name, key)
+        if found:
+            return data
+
+        data = fn(*args, **kwargs)
+
+        store(name, key, data, ttl)
+        return data
+    decorator.__name__ = fn.__name__
+    return decorator
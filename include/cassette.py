@@ -0,0 +1,268 @@
+# -*- coding: utf-8  -*-
+# Cassettes keep every HTTP response and every wiki page a run touched in a
+# SQLite file. Replaying one serves a whole run from that file without any
+# network access, either at full speed or at the recorded latency.
+
+import sqlite3, zlib, json, threading, time, atexit
+import urllib.error
+from collections import defaultdict
+
+import pywikibot
+
+from include import metrics
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS http (url TEXT, seq INTEGER, status INTEGER, reason TEXT, headers TEXT, body BLOB, error TEXT, seconds REAL, PRIMARY KEY (url, seq))',
+    'CREATE TABLE IF NOT EXISTS titles (name TEXT PRIMARY KEY, title TEXT)',
+    'CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, revid INTEGER, text BLOB, seconds REAL)',
+    'CREATE TABLE IF NOT EXISTS revisions (title TEXT, revid INTEGER, user TEXT, text BLOB, PRIMARY KEY (title, revid))',
+    'CREATE TABLE IF NOT EXISTS messages (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS writes (title TEXT, seconds REAL)',
+]
+
+def pack(text):
+    return None if text is None else zlib.compress(text if isinstance(text, bytes) else text.encode('utf-8'))
+
+def unpack(blob, binary = False):
+    if blob is None:
+        return None
+    data = zlib.decompress(blob)
+    return data if binary else data.decode('utf-8')
+
+class Cassette:
+    commit_every = 100
+
+    def __init__(self, path, mode = 'replay', realtime = False):
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self._lock = threading.RLock()
+        self._seq = defaultdict(int)
+        self._writes = 0
+        if mode == 'record':
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        elif not path.is_file():
+            raise FileNotFoundError('No cassette at {}'.format(path))
+        self._db = sqlite3.connect(str(path), check_same_thread = False)
+        for statement in schema:
+            self._db.execute(statement)
+        atexit.register(self.close)
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+    def execute(self, query, args = ()):
+        with self._lock:
+            cursor = self._db.execute(query, args)
+            if self.recording:
+                self._writes += 1
+                if self._writes % self.commit_every == 0:
+                    self._db.commit()
+            return cursor
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def meta(self, key, value = None):
+        if value is not None:
+            self.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+            return value
+        row = self.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def delay(self, seconds):
+        if self.realtime and seconds:
+            time.sleep(seconds)
+
+    # HTTP
+    def request(self, url, fetch):
+        if not self.recording:
+            return self.replay(url)
+        start = time.perf_counter()
+        try:
+            body = fetch(url)
+        except urllib.error.HTTPError as e:
+            self.store(url, time.perf_counter() - start, status = e.code, reason = str(e.reason), headers = dict(e.headers.items()) if e.headers is not None else {})
+            raise
+        except Exception as e:
+            self.store(url, time.perf_counter() - start, error = '{}: {}'.format(type(e).__name__, e))
+            raise
+        self.store(url, time.perf_counter() - start, status = 200, body = body)
+        return body
+
+    def store(self, url, seconds, status = None, reason = None, headers = None, body = None, error = None):
+        with self._lock:
+            seq = self._seq[url]
+            self._seq[url] += 1
+            self.execute('INSERT OR REPLACE INTO http VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (url, seq, status, reason, json.dumps(headers) if headers is not None else None, pack(body), error, seconds))
+
+    def replay(self, url):
+        # Repeated requests get the recorded responses in order; once those
+        # run out the last one is served again
+        with self._lock:
+            seq = self._seq[url]
+            self._seq[url] += 1
+            row = self.execute('SELECT status, reason, headers, body, error, seconds FROM http WHERE url = ? AND seq <= ? ORDER BY seq DESC LIMIT 1', (url, seq)).fetchone()
+        if row is None:
+            metrics.current.request(url, 0, error = True)
+            raise urllib.error.URLError('Not recorded in the cassette')
+        status, reason, headers, body, error, seconds = row
+        self.delay(seconds)
+        body = unpack(body, True) or b''
+        metrics.current.request(url, seconds, len(body), error is not None or status >= 400)
+        if error is not None:
+            if error.startswith('URLError'):
+                raise urllib.error.URLError(error)
+            raise ConnectionError(error)
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, json.loads(headers or '{}'), None)
+        return body
+
+    # Wiki pages
+    def recordTitle(self, name, title):
+        self.execute('INSERT OR IGNORE INTO titles VALUES (?, ?)', (name, title))
+
+    def title(self, name):
+        row = self.execute('SELECT title FROM titles WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def recordPage(self, page, seconds = 0):
+        # Only the first state of a page is kept, which is what a replayed run
+        # starts from
+        if self.execute('SELECT 1 FROM pages WHERE title = ?', (page.title(),)).fetchone() is not None:
+            return
+        try:
+            text, revid = page.get(get_redirect = True), page.latest_revision_id
+        except pywikibot.exceptions.NoPage:
+            text, revid = None, None
+        self.execute('INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?)', (page.title(), revid, pack(text), seconds))
+
+    def page(self, title):
+        row = self.execute('SELECT revid, text, seconds FROM pages WHERE title = ?', (title,)).fetchone()
+        if row is None:
+            return None, None, 0
+        return row[0], unpack(row[1]), row[2]
+
+    def recordRevisions(self, page):
+        for rev in list(page._revisions.values()):
+            self.execute('INSERT OR IGNORE INTO revisions VALUES (?, ?, ?, ?)', (page.title(), rev.revid, rev.user, pack(rev.text)))
+
+    def revisions(self, title, startid = None, total = None):
+        rows = self.execute('SELECT revid, user, text FROM revisions WHERE title = ? AND revid <= ? ORDER BY revid DESC LIMIT ?', (title, startid if startid is not None else 2**62, total if total is not None else -1)).fetchall()
+        return [Revision(revid, user, unpack(text)) for revid, user, text in rows]
+
+    def recordMessage(self, key, value):
+        self.execute('INSERT OR REPLACE INTO messages VALUES (?, ?)', (key, value))
+
+    def message(self, key):
+        row = self.execute('SELECT value FROM messages WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def recordWrite(self, title, seconds):
+        self.execute('INSERT INTO writes VALUES (?, ?)', (title, seconds))
+
+    def writeTime(self, title):
+        row = self.execute('SELECT AVG(seconds) FROM writes WHERE title = ?', (title,)).fetchone()
+        return row[0] or 0
+
+class Revision:
+    def __init__(self, revid, user, text):
+        self.revid = revid
+        self.user = user
+        self.text = text
+
+class ReplaySite:
+    # Stands in for the pywikibot site, serving the pages recorded in a
+    # cassette. Edits only change the in-memory copies
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self.name = cassette.meta('site') or 'unknown'
+        self._revid = 2**40 # Above anything recorded, edits must not reuse revision ids
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return 'replay-' + self.name
+
+    @property
+    def sitename(self):
+        return str(self)
+
+    def username(self):
+        return self.cassette.meta('user')
+
+    def login(self):
+        pass
+
+    def mediawiki_message(self, key):
+        return self.cassette.message(key)
+
+    def nextRevid(self):
+        with self._lock:
+            self._revid += 1
+            return self._revid
+
+    def preloadpages(self, pages, groupsize = 50):
+        for page in pages:
+            page.load()
+            yield page
+
+    def loadrevisions(self, page, content = False, startid = None, total = None, **kwargs):
+        for rev in self.cassette.revisions(page.title(), startid, total):
+            page._revisions[rev.revid] = rev
+
+class ReplayPage:
+    def __init__(self, site, name, ns = 0):
+        self.site = site
+        self._title = site.cassette.title(name) or name
+        self._revisions = {}
+        self._loaded = False
+
+    def __repr__(self):
+        return 'ReplayPage({})'.format(self._title)
+
+    def title(self, with_ns = True, **kwargs):
+        if with_ns:
+            return self._title
+        return self._title.split(':', 1)[-1]
+
+    def load(self):
+        if not self._loaded:
+            self._revid, self._text, seconds = self.site.cassette.page(self._title)
+            self.site.cassette.delay(seconds)
+            self._loaded = True
+
+    def exists(self):
+        self.load()
+        return self._revid is not None
+
+    def get(self, force = False, get_redirect = False):
+        if not self.exists():
+            raise pywikibot.exceptions.NoPage(self)
+        return self._text
+
+    @property
+    def text(self):
+        return self.get()
+
+    @property
+    def latest_revision_id(self):
+        if not self.exists():
+            raise pywikibot.exceptions.NoPage(self)
+        return self._revid
+
+    def put(self, text, summary = None, **kwargs):
+        self.load()
+        self.site.cassette.delay(self.site.cassette.writeTime(self._title))
+        self._text = text
+        self._revid = self.site.nextRevid()
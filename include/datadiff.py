@@ -0,0 +1,80 @@
+# -*- coding: utf-8  -*-
+
+from collections import OrderedDict
+
+from include.manifest import normalize
+
+class Missing:
+    def __repr__(self):
+        return '-'
+MISSING = Missing()
+
+def diff(old, new, ignore = (), path = ()):
+    # Yields (path, old value, new value) for every leaf that differs; keys
+    # that only exist on one side come with MISSING on the other
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if len(path) == 0 and key in ignore:
+                continue
+            if key not in new:
+                yield path + (key,), old[key], MISSING
+            else:
+                for change in diff(old[key], new[key], ignore, path + (key,)):
+                    yield change
+        for key in new:
+            if key not in old and not (len(path) == 0 and key in ignore):
+                yield path + (key,), MISSING, new[key]
+        return
+    if normalize(old) != normalize(new):
+        yield path, old, new
+
+def short(value, limit = 60):
+    text = repr(sorted(value) if isinstance(value, (set, frozenset)) else value)
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+def summarize(changes, limit = 20):
+    # Groups changes by their first two path elements, so that e.g. the list
+    # module reads as added, removed and changed wikis
+    changes = list(changes)
+    if len(changes) == 1 and changes[0][0] == ():
+        path, old, new = changes[0]
+        return ['Created' if old is None else 'Replaced: {} -> {}'.format(short(old), short(new))]
+
+    sections = OrderedDict()
+    for path, old, new in changes:
+        section = sections.setdefault(path[0], OrderedDict())
+        if len(path) == 1:
+            section[None] = (old, new)
+        else:
+            section.setdefault(path[1], []).append((path[2:], old, new))
+
+    lines = []
+    for name, items in sections.items():
+        if None in items:
+            old, new = items.pop(None)
+            lines.append('{}: {} -> {}'.format(name, short(old), short(new)))
+        if len(items) == 0:
+            continue
+
+        added = [key for key, lst in items.items() if len(lst) == 1 and lst[0][0] == () and lst[0][1] is MISSING]
+        removed = [key for key, lst in items.items() if len(lst) == 1 and lst[0][0] == () and lst[0][2] is MISSING]
+        changed = [key for key in items if key not in added and key not in removed]
+
+        lines.append('{}: {:d} added, {:d} removed, {:d} changed'.format(name, len(added), len(removed), len(changed)))
+        for label, keys in [('+', added), ('-', removed)]:
+            if len(keys):
+                lines.append('  {} {}{}'.format(label, ', '.join(str(key) for key in keys[:limit]), ' and {:d} more'.format(len(keys) - limit) if len(keys) > limit else ''))
+        for key in changed[:limit]:
+            fields = []
+            for path, old, new in items[key]:
+                field = '.'.join(str(x) for x in path) or '(value)'
+                if old is MISSING:
+                    fields.append('+{}'.format(field))
+                elif new is MISSING:
+                    fields.append('-{}'.format(field))
+                else:
+                    fields.append('{} {} -> {}'.format(field, short(old, 20), short(new, 20)))
+            lines.append('  ~ {}: {}'.format(key, '; '.join(fields)))
+        if len(changed) > limit:
+            lines.append('  ~ ... and {:d} more'.format(len(changed) - limit))
+    return lines
@@ -0,0 +1,63 @@
+# -*- coding: utf-8  -*-
+
+import json, os
+from collections import defaultdict
+
+from include import tools
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self.time = None
+        self.done = defaultdict(dict)
+        self.saved = set()
+
+    def exists(self):
+        return self.path.is_file()
+
+    def load(self):
+        with open(str(self.path), encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break # Torn last line after a crash
+                if entry['type'] == 'start':
+                    self.time = entry['time']
+                elif entry['type'] == 'saved':
+                    self.saved.add(entry['title'])
+                else:
+                    self.done[entry['type']][entry['id']] = entry['data']
+        self._file = open(str(self.path), 'a', encoding = 'utf-8')
+
+    def start(self, time):
+        self.time = time
+        self.done.clear()
+        self.saved.clear()
+        self._file = open(str(self.path), 'w', encoding = 'utf-8')
+        self.write({'type': 'start', 'time': time})
+
+    def write(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def checkpoint(self, method, id, data):
+        self.write({'type': method, 'id': id, 'data': data})
+
+    def markSaved(self, title):
+        self.saved.add(title)
+        self.write({'type': 'saved', 'title': title})
+
+    def finish(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+def forSite(site):
+    return Journal(tools.siteFile('journal', site, '.jsonl'))
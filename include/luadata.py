@@ -0,0 +1,277 @@
+# -*- coding: utf-8  -*-
+# Fast codec for the subset of Lua the bot writes to data modules: a single
+# returned table of tables, strings, numbers, booleans and nil. Anything
+# outside that subset is handed over to luad.
+
+import re
+
+from include import luad
+
+class Unsupported(ValueError):
+    pass
+
+_space = re.compile(r'(?:\s+|--(?:\[(=*)\[.*?\]\1\]|[^\n]*))*', re.S)
+_number = re.compile(r'-?(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+_name = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_simple = {
+    "'": re.compile(r"'([^'\\\n]*)'"),
+    '"': re.compile(r'"([^"\\\n]*)"'),
+}
+_chunk = {
+    "'": re.compile(r"[^'\\\n]*"),
+    '"': re.compile(r'[^"\\\n]*'),
+}
+_long = re.compile(r'\[(=*)\[\n?(.*?)\]\1\]', re.S)
+_escapes = {
+    'n': '\n', 't': '\t', 'r': '\r', 'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v',
+    '\\': '\\', '"': '"', "'": "'", '\n': '\n',
+}
+_decimal = re.compile(r'\d{1,3}')
+_entry = re.compile(r"""\s*\[(?:'([^'\\\n]*)'|(-?\d+))\]\s*=\s*(?:'([^'\\\n]*)'|(-?\d+)(?=\s*[,;}])|(true|false|nil)\b)?""")
+_separator = re.compile(r'\s*([,;}])')
+_constants = {'true': True, 'false': False, 'nil': None}
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def skip(self):
+        self.pos = _space.match(self.text, self.pos).end()
+
+    def peek(self):
+        self.skip()
+        try:
+            return self.text[self.pos]
+        except IndexError:
+            raise Unsupported('Unexpected end of input')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise Unsupported('Expected {!r} at {:d}'.format(char, self.pos))
+        self.pos += 1
+
+    def parse(self):
+        self.skip()
+        if self.text.startswith('return', self.pos):
+            self.pos += 6
+        value = self.value()
+        self.skip()
+        if self.pos != len(self.text):
+            raise Unsupported('Trailing data at {:d}'.format(self.pos))
+        return value
+
+    def value(self):
+        c = self.peek()
+        if c == '{':
+            return self.table()
+        if c == "'" or c == '"':
+            return self.string(c)
+        if c == '[':
+            m = _long.match(self.text, self.pos)
+            if m is None:
+                raise Unsupported('Invalid long string at {:d}'.format(self.pos))
+            self.pos = m.end()
+            return m.group(2)
+        m = _number.match(self.text, self.pos)
+        if m is not None:
+            self.pos = m.end()
+            token = m.group(0)
+            try:
+                if 'x' in token or 'X' in token:
+                    return int(token, 16)
+                if '.' in token or 'e' in token or 'E' in token:
+                    return float(token)
+                return int(token)
+            except ValueError:
+                raise Unsupported('Invalid number {!r}'.format(token))
+        m = _name.match(self.text, self.pos)
+        if m is not None and m.group(0) in _constants:
+            self.pos = m.end()
+            return _constants[m.group(0)]
+        raise Unsupported('Unsupported expression at {:d}'.format(self.pos))
+
+    def string(self, quote):
+        m = _simple[quote].match(self.text, self.pos)
+        if m is not None:
+            self.pos = m.end()
+            return m.group(1)
+
+        text, chunk = self.text, _chunk[quote]
+        pos = self.pos + 1
+        parts = []
+        while True:
+            m = chunk.match(text, pos)
+            parts.append(m.group(0))
+            pos = m.end()
+            try:
+                c = text[pos]
+            except IndexError:
+                raise Unsupported('Unfinished string')
+            if c == quote:
+                self.pos = pos + 1
+                return ''.join(parts)
+            if c == '\n':
+                raise Unsupported('Unfinished string')
+            c = text[pos + 1:pos + 2]
+            if c in _escapes:
+                parts.append(_escapes[c])
+                pos += 2
+                continue
+            m = _decimal.match(text, pos + 1)
+            if m is None:
+                raise Unsupported('Unsupported escape sequence at {:d}'.format(pos))
+            parts.append(chr(int(m.group(0))))
+            pos = m.end()
+
+    def table(self):
+        self.pos += 1
+        seq = []
+        keyed = {}
+        text = self.text
+        entry, separator = _entry.match, _separator.match
+        while True:
+            m = entry(text, self.pos)
+            if m is not None:
+                # Fast path for the ['key'] = scalar entries that make up most of the data
+                skey, ikey, sval, ival, const = m.groups()
+                self.pos = m.end()
+                key = skey if skey is not None else int(ikey)
+                if sval is not None:
+                    keyed[key] = sval
+                elif ival is not None:
+                    keyed[key] = int(ival)
+                elif const is not None:
+                    keyed[key] = _constants[const]
+                else:
+                    keyed[key] = self.value()
+            else:
+                c = self.peek()
+                if c == '}':
+                    self.pos += 1
+                    break
+                if c == '[' and text[self.pos + 1:self.pos + 2] not in ('[', '='):
+                    self.pos += 1
+                    key = self.value()
+                    self.expect(']')
+                    self.expect('=')
+                    keyed[key] = self.value()
+                else:
+                    m = _name.match(text, self.pos)
+                    if m is not None and m.group(0) not in _constants:
+                        self.pos = m.end()
+                        self.expect('=')
+                        keyed[m.group(0)] = self.value()
+                    else:
+                        seq.append(self.value())
+            m = separator(text, self.pos)
+            c = m.group(1) if m is not None else self.peek()
+            if m is not None:
+                self.pos = m.end()
+            elif c == ',' or c == ';' or c == '}':
+                self.pos += 1
+            else:
+                raise Unsupported('Expected separator at {:d}'.format(self.pos))
+            if c == '}':
+                break
+
+        if len(keyed) == 0:
+            return seq if len(seq) else {}
+        for i, value in enumerate(seq, 1):
+            keyed.setdefault(i, value)
+        return keyed
+
+def loads(text):
+    try:
+        return Parser(text).parse()
+    except Unsupported:
+        return luad.loads(text)
+
+_escape = str.maketrans({
+    '\\': '\\\\',
+    "'": "\\'",
+    '\n': '\\n',
+    '\r': '\\r',
+    '\0': '\\000',
+})
+
+def _key(key):
+    if isinstance(key, bool):
+        raise Unsupported('Boolean table key')
+    if isinstance(key, (int, float)):
+        return (0, key, '')
+    if isinstance(key, str):
+        return (1, 0, key)
+    raise Unsupported('Unsupported key type {}'.format(type(key).__name__))
+
+_special = re.compile(r"[\\'\n\r\0]").search
+
+def _scalar(value):
+    t = type(value)
+    if t is str:
+        if _special(value) is None:
+            return "'" + value + "'"
+        return "'" + value.translate(_escape) + "'"
+    if t is int:
+        return str(value)
+    if value is None:
+        return 'nil'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise Unsupported('Non-finite number')
+        return repr(value)
+    if isinstance(value, str):
+        return _scalar(str(value))
+    raise Unsupported('Unsupported value type {}'.format(type(value).__name__))
+
+def _sorted(keys):
+    try:
+        return sorted(keys)
+    except TypeError:
+        return sorted(keys, key = _key)
+
+def _items(data):
+    if isinstance(data, dict):
+        return [('[' + _scalar(key) + '] = ', data[key]) for key in _sorted(data)]
+    if isinstance(data, (list, tuple)):
+        return [('', value) for value in data]
+    if isinstance(data, (set, frozenset)):
+        return [('', value) for value in _sorted(data)]
+    return None
+
+def _write(data, indent, level, out):
+    items = _items(data)
+    if items is None:
+        out.append(_scalar(data))
+    elif len(items) == 0:
+        out.append('{}')
+    elif indent is None:
+        out.append('{')
+        for i, (prefix, value) in enumerate(items):
+            if i:
+                out.append(', ')
+            out.append(prefix)
+            _write(value, indent, level + 1, out)
+        out.append('}')
+    else:
+        pad = '\n' + ' ' * (indent * (level + 1))
+        out.append('{')
+        for prefix, value in items:
+            out.append(pad + prefix)
+            _write(value, indent, level + 1, out)
+            out.append(',')
+        out.append('\n' + ' ' * (indent * level) + '}')
+
+def dumps(data, indent = None):
+    try:
+        out = []
+        _write(data, indent, 0, out)
+        return ''.join(out)
+    except Unsupported:
+        return luad.dumps(data, indent = indent)
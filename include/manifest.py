@@ -0,0 +1,61 @@
+# -*- coding: utf-8  -*-
+
+import json, hashlib
+from time import time
+
+from include import tools
+
+def normalize(value):
+    if isinstance(value, (dict, list, tuple, set, frozenset)) and len(value) == 0:
+        return {} # All of them are an empty table in Lua
+    if isinstance(value, dict):
+        return {str(key): normalize(val) for key, val in value.items()}
+    if isinstance(value, (set, frozenset)):
+        return sorted([normalize(val) for val in value], key = repr)
+    if isinstance(value, (list, tuple)):
+        return [normalize(val) for val in value]
+    return value
+
+def payloadHash(data, ignore = ('updated_timestamp',)):
+    if isinstance(data, dict):
+        data = {key: val for key, val in data.items() if key not in ignore}
+    text = json.dumps(normalize(data), sort_keys = True, separators = (',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class Manifest:
+    save_every = 50
+
+    def __init__(self, path):
+        self.path = path
+        self._changes = 0
+        try:
+            with open(str(path), encoding = 'utf-8') as f:
+                self.pages = json.load(f)
+        except (IOError, ValueError):
+            self.pages = {}
+
+    def get(self, title):
+        return self.pages.get(title)
+
+    def matches(self, title, hash, revid):
+        entry = self.pages.get(title)
+        return entry is not None and entry['hash'] == hash and entry['revid'] == revid
+
+    def record(self, title, hash, revid):
+        self.pages[title] = {
+            'hash': hash,
+            'revid': revid,
+            'timestamp': int(time()),
+        }
+        self._changes += 1
+        if self._changes % self.save_every == 0:
+            self.save()
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(str(tmp), 'w', encoding = 'utf-8') as f:
+            json.dump(self.pages, f)
+        tmp.replace(self.path)
+
+def forSite(site):
+    return Manifest(tools.siteFile('manifest', site, '.json'))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8  -*-
+
+import json, threading, heapq, urllib.parse
+from time import time, perf_counter
+from contextlib import contextmanager
+from collections import defaultdict
+
+buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+slowest_count = 20
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = 0
+        while i < len(buckets) and seconds > buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def dump(self):
+        count = sum(self.counts)
+        return {
+            'count': count,
+            'total': round(self.total, 3),
+            'mean': round(self.total / count, 4) if count else None,
+            'max': round(self.max, 4),
+            'buckets': {('<= {}s'.format(limit) if limit is not None else '> {}s'.format(buckets[-1])): n for limit, n in zip(buckets + [None], self.counts)},
+        }
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def dump(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'latency': self.latency.dump(),
+        }
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time()
+        self.timers = defaultdict(Histogram)
+        self.endpoints = defaultdict(Stats)
+        self.hosts = defaultdict(Stats)
+        self.pages = defaultdict(Stats)
+        self.slowest = []
+        self.tasks = defaultdict(Histogram)
+
+    def time(self, name, seconds):
+        with self._lock:
+            self.timers[name].add(seconds)
+
+    def request(self, url, seconds, size = 0, error = False):
+        endpoint, host = describe(url)
+        with self._lock:
+            for stats in (self.endpoints[endpoint], self.hosts[host]):
+                stats.requests += 1
+                stats.bytes += size
+                stats.latency.add(seconds)
+                if error:
+                    stats.errors += 1
+
+    def retry(self, url):
+        endpoint, host = describe(url)
+        with self._lock:
+            self.endpoints[endpoint].retries += 1
+            self.hosts[host].retries += 1
+
+    def page(self, kind, seconds, size = 0):
+        with self._lock:
+            stats = self.pages[kind]
+            stats.requests += 1
+            stats.bytes += size
+            stats.latency.add(seconds)
+
+    def wiki(self, wiki, task, seconds):
+        entry = (seconds, wiki.id, task, wiki.domain)
+        with self._lock:
+            self.tasks[task].add(seconds)
+            if len(self.slowest) < slowest_count:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def report(self, **extra):
+        from include import cache
+        with self._lock:
+            data = {
+                'started': int(self.started),
+                'duration': round(time() - self.started, 3),
+                'timers': {name: hist.dump() for name, hist in sorted(self.timers.items())},
+                'endpoints': {name: stats.dump() for name, stats in sorted(self.endpoints.items())},
+                'hosts': {name: stats.dump() for name, stats in sorted(self.hosts.items())},
+                'pages': {name: stats.dump() for name, stats in sorted(self.pages.items())},
+                'cache': {},
+                'wiki_tasks': {name: hist.dump() for name, hist in sorted(self.tasks.items())},
+                'slowest_wikis': [{'id': id, 'task': task, 'domain': domain, 'seconds': round(seconds, 3)} for seconds, id, task, domain in sorted(self.slowest, reverse = True)],
+            }
+        for ns, counts in cache.getCache().stats().items():
+            total = counts['hits'] + counts['misses']
+            data['cache'][ns] = dict(counts, hit_rate = round(counts['hits'] / total, 4) if total else None)
+        data.update(extra)
+        return data
+
+    def write(self, path, **extra):
+        with open(str(path), 'w', encoding = 'utf-8') as f:
+            json.dump(self.report(**extra), f, indent = 2)
+
+def describe(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.path.endswith('/index.php'):
+        query = urllib.parse.parse_qs(parts.query)
+        endpoint = query.get('rs', query.get('action', ['index.php']))[0].split('::')[0]
+    elif '/api/v1/' in parts.path:
+        endpoint = parts.path.split('/api/v1/', 1)[1]
+    else:
+        endpoint = parts.path
+    return endpoint, parts.netloc
+
+current = Metrics()
+
+def reset():
+    global current
+    current = Metrics()
+    return current
+
+@contextmanager
+def timer(name):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        current.time(name, perf_counter() - start)
+
+def timed(fn):
+    def decorator(*args, **kwargs):
+        with timer(fn.__name__):
+            return fn(*args, **kwargs)
+    decorator.__name__ = fn.__name__
+    return decorator
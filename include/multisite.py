@@ -0,0 +1,31 @@
+# -*- coding: utf-8  -*-
+# Runs the bot for several sites in one process, one after another. The wiki
+# registry, the API cache and the HTTP pool are process-wide already; on top
+# of that the Details, WAM pages and admin counts fetched for one site are kept
+# for the rest of the cycle, so wikis on several lists are only fetched once.
+
+import pywikibot
+from pywikibot import output
+
+from include import api, metrics
+from include.bot import Bot
+
+def getSite(spec):
+    # Either 'family:code' or the code of the configured family
+    family, sep, code = spec.rpartition(':')
+    return pywikibot.Site(code, family or None)
+
+def run(specs, args):
+    if any(arg.startswith(('-record:', '-replay:')) for arg in args):
+        return output('\03{lightred}Cassettes only work with a single site\03{default}')
+
+    sites = [getSite(spec) for spec in specs]
+    api.shared = {}
+    Bot.shared = {}
+    try:
+        for site in sites:
+            metrics.reset()
+            Bot(site, list(args)).run()
+    finally:
+        api.shared = None
+        Bot.shared = None
@@ -0,0 +1,210 @@
+# -*- coding: utf-8  -*-
+
+import http.client, threading, socket, gzip, io, time
+import urllib.parse, urllib.error, urllib.request
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from include import metrics
+
+workers = 8
+maxsize = 8 # idle connections kept per host
+max_idle = 64 # idle connections kept overall, least recently used go first
+idle_timeout = 30 # seconds an idle connection is kept
+timeout = 60
+max_redirects = 5
+
+global_rps = None
+host_rps = None
+
+# (scheme, host) every request is sent to instead, with the original Host
+# header kept, e.g. to run against a local stand-in server
+override = None
+
+# Cassette that records or replays every request, see include.cassette
+tape = None
+
+headers = {
+    'User-Agent': 'Python-urllib/' + urllib.request.__version__,
+    'Accept-Encoding': 'gzip',
+    'Connection': 'keep-alive',
+}
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.interval = 1 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+class ConnectionPool:
+    def __init__(self, maxsize = maxsize, max_idle = max_idle):
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self._idle = defaultdict(list)
+        self._released = OrderedDict() # conn -> (key, time), oldest first
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def limiter(self, key, rate):
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None or limiter.rate != rate:
+                limiter = self._limiters[key] = RateLimiter(rate)
+            return limiter
+
+    def throttle(self, host):
+        if global_rps:
+            self.limiter(None, global_rps).wait()
+        if host_rps:
+            self.limiter(host, host_rps).wait()
+
+    def acquire(self, scheme, host):
+        with self._lock:
+            expired = self.expire()
+            idle = self._idle[(scheme, host)]
+            conn = idle.pop() if len(idle) else None
+            if conn is not None:
+                del self._released[conn]
+            if len(idle) == 0:
+                del self._idle[(scheme, host)]
+        for old in expired:
+            old.close()
+        if conn is not None:
+            return conn, True
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(host, timeout = timeout), False
+
+    def release(self, scheme, host, conn):
+        with self._lock:
+            idle = self._idle[(scheme, host)]
+            if len(idle) >= self.maxsize:
+                return conn.close()
+            idle.append(conn)
+            self._released[conn] = ((scheme, host), time.monotonic())
+            drop = []
+            while len(self._released) > self.max_idle:
+                drop.append(self.forget(*self._released.popitem(last = False)))
+        for conn in drop:
+            conn.close()
+
+    def forget(self, conn, entry):
+        # Takes an idle connection out of its host's list, the lock is held
+        key, released = entry
+        idle = self._idle[key]
+        idle.remove(conn)
+        if len(idle) == 0:
+            del self._idle[key]
+        return conn
+
+    def expire(self):
+        # Idle connections the server has most likely dropped by now
+        limit = time.monotonic() - idle_timeout
+        expired = []
+        while len(self._released):
+            conn, entry = next(iter(self._released.items()))
+            if entry[1] > limit:
+                break
+            del self._released[conn]
+            expired.append(self.forget(conn, entry))
+        return expired
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+            self._released.clear()
+        for lst in idle.values():
+            for conn in lst:
+                conn.close()
+
+    def _send(self, scheme, host, path):
+        send = headers
+        if override is not None:
+            send = dict(headers, Host = host)
+            scheme, host = override
+        while True:
+            conn, reused = self.acquire(scheme, host)
+            try:
+                conn.request('GET', path, headers = send)
+                response = conn.getresponse()
+                body = response.read()
+            except socket.gaierror as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused:
+                    # Server dropped an idle keep-alive connection, retry on a fresh one
+                    continue
+                if isinstance(e, OSError):
+                    raise
+                raise ConnectionError(str(e))
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(scheme, host, conn)
+
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            return response, body
+
+    def request(self, url):
+        for i in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            self.throttle(parts.netloc)
+            start = time.perf_counter()
+            try:
+                response, body = self._send(parts.scheme, parts.netloc, path)
+            except Exception:
+                metrics.current.request(url, time.perf_counter() - start, error = True)
+                raise
+            metrics.current.request(url, time.perf_counter() - start, len(body), response.status >= 400)
+
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            return body
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, io.BytesIO(body))
+
+connections = ConnectionPool()
+
+def request(url):
+    if tape is not None:
+        return tape.request(url, connections.request)
+    return connections.request(url)
+
+__executor = None
+__executor_lock = threading.Lock()
+def executor():
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            __executor = ThreadPoolExecutor(max_workers = workers)
+        return __executor
+
+def submit(fn, *args, **kwargs):
+    return executor().submit(fn, *args, **kwargs)
+
+def shutdown():
+    global __executor
+    with __executor_lock:
+        if __executor is not None:
+            __executor.shutdown()
+            __executor = None
+    connections.close()
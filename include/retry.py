@@ -0,0 +1,96 @@
+# -*- coding: utf-8  -*-
+# Retry policy for API requests: jittered exponential backoff that honours
+# Retry-After, and a per-host circuit breaker that fails fast while a host
+# keeps erroring.
+
+import random, threading, time, email.utils, urllib.parse
+from collections import defaultdict
+
+tries = 5
+base_delay = 3
+max_delay = 300
+
+threshold = 5 # consecutive failures before a host is cut off
+cooldown = 120 # seconds before a single trial request is let through again
+
+exempt = set() # hosts that are never cut off, like the central API
+
+def retryAfter(error):
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def delay(attempt, error = None):
+    after = retryAfter(error)
+    if after is not None:
+        return min(after, max_delay)
+    d = min(max_delay, base_delay * 2 ** attempt)
+    return d / 2 + random.uniform(0, d / 2)
+
+class Breaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        # Returns True when this failure cut the host off
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures < threshold:
+                return False
+            opened = self.opened is None
+            self.opened = time.monotonic()
+            return opened
+
+class Exempt:
+    # Breaker of a host the run cannot do without
+    def allow(self):
+        return True
+    
+    def success(self):
+        pass
+    
+    def failure(self):
+        return False
+
+_exempt = Exempt()
+_breakers = defaultdict(Breaker)
+_lock = threading.Lock()
+
+def breaker(url):
+    host = urllib.parse.urlsplit(url).netloc
+    if host in exempt:
+        return _exempt
+    with _lock:
+        return _breakers[host]
+
+def reset():
+    with _lock:
+        _breakers.clear()
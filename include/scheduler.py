@@ -0,0 +1,76 @@
+# -*- coding: utf-8  -*-
+
+import json, heapq
+from time import time
+
+from include import tools
+
+# ListusersAjax, WikiVariables, module read and module write
+request_cost = 4
+
+activity_keys = ['edits', 'articles', 'pages', 'images', 'activeUsers']
+
+class Scheduler:
+    default_cost = 5.0
+    max_staleness = 365.0
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(str(path), encoding = 'utf-8') as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {}
+
+    @property
+    def seconds_per_wiki(self):
+        return self.state.get('seconds_per_wiki', self.default_cost)
+
+    def measure(self, count, seconds):
+        if count == 0:
+            return
+        cost = seconds / count
+        old = self.state.get('seconds_per_wiki')
+        self.state['seconds_per_wiki'] = cost if old is None else (old + cost) / 2
+        with open(str(self.path), 'w', encoding = 'utf-8') as f:
+            json.dump(self.state, f)
+
+    def capacity(self, seconds = None, requests = None, limit = None):
+        lst = [limit]
+        if seconds is not None:
+            lst.append(int(seconds / self.seconds_per_wiki))
+        if requests is not None:
+            lst.append(int(requests / request_cost))
+        lst = [x for x in lst if x is not None]
+        return max(0, min(lst)) if len(lst) else None
+
+    def staleness(self, saved):
+        if saved is None:
+            return self.max_staleness
+        return min(self.max_staleness, (time() - saved) / 86400)
+
+    def activity(self, old, new):
+        if not old or not new:
+            return 1.0
+        score = 0.0
+        for key in activity_keys:
+            try:
+                score += abs(new[key] - old[key]) / max(1, old[key])
+            except (KeyError, TypeError):
+                pass
+        return score
+
+    def select(self, entries, capacity = None):
+        # entries: (wiki, tier, saved timestamp, old stats)
+        heap = []
+        for wiki, tier, saved, stats in entries:
+            score = self.staleness(saved) * (1 + self.activity(stats, wiki.stats))
+            heapq.heappush(heap, (tier, -score, wiki.id, wiki))
+
+        lst = []
+        while len(heap) and (capacity is None or len(lst) < capacity or heap[0][0] == 0):
+            lst.append(heapq.heappop(heap)[3])
+        return lst
+
+def forSite(site):
+    return Scheduler(tools.siteFile('scheduler', site, '.json'))
@@ -0,0 +1,183 @@
+# -*- coding: utf-8  -*-
+# Append-only store of the daily stats of every wiki. Each column lives in its
+# own file of fixed-width integers (wiki id, day, then one file per stat) that
+# is memory-mapped for reading. A run appends one row per wiki; rows for the
+# same wiki and day are merged on read, later values winning.
+
+import json, mmap, struct
+from datetime import date
+
+from include import tools
+
+MISSING = -2**63
+
+_epoch = date(1970, 1, 1).toordinal()
+
+def toDay(text):
+    return date(*map(int, text.split('-'))).toordinal() - _epoch
+
+def fromDay(day):
+    return date.fromordinal(day + _epoch).strftime('%Y-%m-%d')
+
+class Column:
+    def __init__(self, path, code):
+        self.path = path
+        self.code = code
+        self.width = struct.calcsize(code)
+        self._file = None
+        self._map = None
+        self._view = None
+        self.mapped = 0
+
+    def size(self):
+        try:
+            return self.path.stat().st_size // self.width
+        except FileNotFoundError:
+            return 0
+
+    def truncate(self, rows):
+        if self.path.is_file() and self.path.stat().st_size != rows * self.width:
+            with open(str(self.path), 'r+b') as f:
+                f.truncate(rows * self.width)
+
+    def pad(self, rows):
+        # Brings a column that was added later up to the current row count
+        missing = rows - self.size()
+        if missing > 0:
+            with open(str(self.path), 'ab') as f:
+                f.write(struct.pack(self.code, MISSING if self.code == 'q' else 0) * missing)
+
+    def append(self, value):
+        if self._file is None:
+            self._file = open(str(self.path), 'ab')
+        self._file.write(struct.pack(self.code, value))
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def view(self, rows):
+        if self.mapped < rows:
+            self.flush()
+            self.unmap()
+            with open(str(self.path), 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            self._view = memoryview(self._map).cast(self.code)
+            self.mapped = rows
+        return self._view
+
+    def unmap(self):
+        if self._view is not None:
+            self._view.release()
+            self._map.close()
+            self._view = self._map = None
+            self.mapped = 0
+
+    def close(self):
+        self.unmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class TimeSeries:
+    def __init__(self, path):
+        self.path = path
+        path.mkdir(parents = True, exist_ok = True)
+        try:
+            with open(str(path / 'keys.json'), encoding = 'utf-8') as f:
+                self.keys = json.load(f)
+        except (IOError, ValueError):
+            self.keys = []
+        self.ids = Column(path / 'id.q', 'q')
+        self.days = Column(path / 'day.i', 'i')
+        self.columns = {key: Column(path / '{:d}.q'.format(i), 'q') for i, key in enumerate(self.keys)}
+
+        # Rows written only partially before a crash are dropped
+        self.rows = min([self.ids.size(), self.days.size()] + [column.size() for column in self.columns.values()])
+        for column in self.all():
+            column.truncate(self.rows)
+
+        # Rows appended by this process are read back from memory, so that the
+        # files need not be mapped again after every append
+        self.mapped = self.rows
+        self.tail = []
+        
+        self.index = {}
+        if self.rows:
+            for row, id in enumerate(self.ids.view(self.rows)[:self.rows]):
+                self.index.setdefault(id, []).append(row)
+
+    def all(self):
+        return [self.ids, self.days] + list(self.columns.values())
+
+    def column(self, key):
+        try:
+            return self.columns[key]
+        except KeyError:
+            pass
+        column = self.columns[key] = Column(self.path / '{:d}.q'.format(len(self.keys)), 'q')
+        column.pad(self.rows)
+        self.keys.append(key)
+        tmp = self.path / 'keys.json.tmp'
+        with open(str(tmp), 'w', encoding = 'utf-8') as f:
+            json.dump(self.keys, f)
+        tmp.replace(self.path / 'keys.json')
+        return column
+
+    def append(self, id, day, stats):
+        # Only integer stats are kept
+        values = {key: value for key, value in stats.items() if isinstance(value, int) and not isinstance(value, bool) and value != MISSING}
+        for key in values:
+            self.column(key)
+        self.ids.append(id)
+        self.days.append(toDay(day))
+        for key, column in self.columns.items():
+            column.append(values.get(key, MISSING))
+        self.tail.append((toDay(day), values))
+        self.index.setdefault(id, []).append(self.rows)
+        self.rows += 1
+
+    def has(self, id):
+        return id in self.index
+
+    def history(self, id, keys = None):
+        # Returns {'YYYY-MM-DD': {stat: value}} with every recorded day
+        rows = self.index.get(id, [])
+        if len(rows) == 0:
+            return {}
+        keys = [key for key in (self.keys if keys is None else keys) if key in self.columns]
+        if rows[0] < self.mapped:
+            days = self.days.view(self.mapped)
+            columns = [(key, self.columns[key].view(self.mapped)) for key in keys]
+        res = {}
+        for row in rows:
+            if row >= self.mapped:
+                day, values = self.tail[row - self.mapped]
+                res.setdefault(day, {}).update((key, values[key]) for key in keys if key in values)
+                continue
+            values = res.setdefault(days[row], {})
+            for key, view in columns:
+                value = view[row]
+                if value != MISSING:
+                    values[key] = value
+        return {fromDay(day): res[day] for day in sorted(res) if len(res[day])}
+
+    def window(self, id, days):
+        history = self.history(id)
+        return {day: history[day] for day in list(history)[-days:]}
+
+    def trend(self, id, key, days = None):
+        # Returns [(date, value)] of one stat, oldest first
+        lst = [(day, values[key]) for day, values in self.history(id, [key]).items() if key in values]
+        return lst if days is None else lst[-days:]
+
+    def flush(self):
+        for column in self.all():
+            column.flush()
+
+    def close(self):
+        for column in self.all():
+            column.close()
+
+def forSite(site):
+    return TimeSeries(tools.siteFile('stats', site, ''))
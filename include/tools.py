@@ -1,5 +1,16 @@
 # -*- coding: utf-8  -*-
-import sys
+import sys, re
+from pathlib import Path
+
+dataDir = 'data'
+
+def dataFile(*parts):
+    path = Path(dataDir, *parts)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    return path
+
+def siteFile(directory, site, extension):
+    return dataFile(directory, re.sub(r'[^\w.-]+', '-', str(site)) + extension)
 
 def progressBar(percentage, label = 'Progress'):
     bar = ' '* max(20, 70-len(label))
@@ -1,9 +1,11 @@
 # -*- coding: utf-8  -*-
 
-import re
+import re, threading
 import dateutil.parser
+from array import array
 from datetime import datetime
-from collections import OrderedDict, Container
+from collections.abc import MutableMapping
+from concurrent.futures import Future
 
 from include import api
 
@@ -15,26 +17,164 @@ def newWiki(data):
     except KeyError:
         return InvalidWiki(data['id']).update(data)
 
+users_batch = 100
+
+_months = {name: i for i, name in enumerate(['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december'], 1)}
+_username = re.compile('\>([^<]+)\</a\>')
+_date = re.compile('\>([^>]*(?:{})[^<]*)\<'.format('|'.join(_months)), flags = re.I)
+_time = re.compile('^\s*(\d{1,2}):(\d{2}), ([a-z]+) (\d{1,2}), (\d{4})\s*$', flags = re.I)
+_tag = re.compile('\<[^>]*\>')
+
+def parseDate(html):
+    # Last edit dates come as "13:37, January 2, 2019" with uselang=en; other
+    # layouts go through dateutil
+    m = _date.search(html)
+    if m is None:
+        return None
+    text = m.group(1)
+    m = _time.match(text)
+    if m is not None and m.group(3).lower() in _months:
+        return datetime(int(m.group(5)), _months[m.group(3).lower()], int(m.group(4)), int(m.group(1)), int(m.group(2)))
+    return dateutil.parser.parse(text)
+
 def getCode(text):
     return re.sub('\.(wikia\.com|wikia\.org|fandom\.com)(\/|$)', r'\2', text, flags = re.I)
 
-_wikis = {}
-class Wiki:
-    id = None
-    domain = None
-    language = None
-    name = None
-    hub = None
-    wordmark = None
-    image = None
+def urlDomain(text):
+    # The domain of a queued url, with the language path but without the
+    # scheme and the page
+    domain = re.match('^\s*(?:(?:https?\:)?\/\/)?([^?#\s]*)', text).group(1).lower()
+    return re.sub('\/wiki(\/.*)?$', '', domain).rstrip('/')
+
+def normalizeURL(text):
+    # Reduces a queued url to a wiki code, so that foo.fandom.com,
+    # https://foo.wikia.com/ and foo.fandom.com/wiki/Bar all end up as foo
+    return getCode(urlDomain(text))
+
+def getDomain(code):
+    host, sep, path = code.partition('/')
+    if '.' not in host:
+        host += '.fandom.com'
+    return host + sep + path
+
+MISSING = -2**63
+
+class StatsStore:
+    # Column-oriented storage for the stats of every wiki: one int64 array per
+    # stat, indexed by Wiki.index. Values that are not integers go to a plain
+    # list column instead.
+    def __init__(self):
+        self.size = 0
+        self.present = bytearray()
+        self.columns = {}
+        self._lock = threading.Lock()
+    
+    def allocate(self):
+        with self._lock:
+            index = self.size
+            self.size += 1
+            self.present.append(0)
+            for column in self.columns.values():
+                column.append(MISSING if isinstance(column, array) else None)
+            return index
+    
+    def column(self, key, value):
+        try:
+            return self.columns[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self.columns:
+                if isinstance(value, int) and not isinstance(value, bool):
+                    self.columns[key] = array('q', [MISSING]) * self.size
+                else:
+                    self.columns[key] = [None] * self.size
+            return self.columns[key]
+    
+    def get(self, index, key):
+        column = self.columns[key]
+        value = column[index]
+        if value is None or value == MISSING and isinstance(column, array):
+            raise KeyError(key)
+        return value
+    
+    def set(self, index, key, value):
+        column = self.column(key, value)
+        if isinstance(column, array):
+            if isinstance(value, int) and not isinstance(value, bool) and value != MISSING:
+                column[index] = value
+                return
+            # Column has to hold something else than integers from now on
+            with self._lock:
+                column = self.columns[key] = [None if x == MISSING else x for x in column]
+        column[index] = value
+    
+    def delete(self, index, key):
+        self.get(index, key)
+        column = self.columns[key]
+        column[index] = MISSING if isinstance(column, array) else None
+    
+    def keys(self, index):
+        for key, column in list(self.columns.items()):
+            value = column[index]
+            if value is not None and not (value == MISSING and isinstance(column, array)):
+                yield key
     
-    discussions = False
+    def assign(self, index, data):
+        self.clear(index)
+        for key, value in data.items():
+            self.set(index, key, value)
+        self.present[index] = 1
     
-    api = None
-    stats = None
+    def clear(self, index):
+        for key in list(self.keys(index)):
+            self.delete(index, key)
+        self.present[index] = 0
+
+class StatsView(MutableMapping):
+    __slots__ = ('store', 'index')
+    
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+    
+    def __getitem__(self, key):
+        try:
+            return self.store.get(self.index, key)
+        except KeyError:
+            raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        self.store.set(self.index, key, value)
+    
+    def __delitem__(self, key):
+        try:
+            self.store.delete(self.index, key)
+        except KeyError:
+            raise KeyError(key)
     
-    onList = False
-    status = None
+    def __iter__(self):
+        return self.store.keys(self.index)
+    
+    def __len__(self):
+        return sum(1 for key in self)
+    
+    def __repr__(self):
+        return repr(self.copy())
+    
+    def copy(self):
+        return {key: self[key] for key in self}
+
+_stats = StatsStore()
+
+_wikis = {}
+class Wiki:
+    __slots__ = (
+        'id', 'index', 'domain', 'language', 'name', 'hub', 'wordmark', 'image', 'discussions',
+        'onList', 'status',
+        'has_details', 'mainpage', 'categories', 'favicon', 'anonediting', 'coppa', 'theme',
+        'has_admin_count', 'active_bureaucrats', 'active_admins', 'active_mods',
+    )
     
     admin_groups = ['bureaucrat', 'sysop']
     mod_groups = ['threadmoderator', 'content-moderator', 'chatmoderator']
@@ -46,9 +186,44 @@ class Wiki:
         
         _wikis[id] = self = object.__new__(cls)
         self.id = id
-        self.api = WikiAPI(self)
+        self.index = _stats.allocate()
+        for attr in ['domain', 'language', 'name', 'hub', 'wordmark', 'image', 'status']:
+            setattr(self, attr, None)
+        self.discussions = False
+        self.onList = False
+        self.has_details = False
+        self.has_admin_count = False
         return self
     
+    @property
+    def api(self):
+        return WikiAPI(self)
+    
+    @property
+    def stats(self):
+        if not _stats.present[self.index]:
+            return None
+        return StatsView(_stats, self.index)
+    
+    @stats.setter
+    def stats(self, data):
+        if data is None:
+            _stats.clear(self.index)
+        else:
+            _stats.assign(self.index, data)
+    
+    def bury(self):
+        # Invalid and closed wikis only need what the log table and the
+        # removed list show
+        self.stats = None
+        for attr in ['mainpage', 'categories', 'favicon', 'anonediting', 'coppa', 'theme', 'active_bureaucrats', 'active_admins', 'active_mods']:
+            try:
+                delattr(self, attr)
+            except AttributeError:
+                pass
+        self.has_details = False
+        self.has_admin_count = False
+    
     def __repr__(self):
         lst = [self.domain or '#{}'.format(self.id)]
         if self.language is not None:
@@ -70,8 +245,7 @@ class Wiki:
             self.language = data['lang']
             
             self.hub = data['hub']
-            self.stats = data['stats']
-            del self.stats['users']
+            self.stats = {key: value for key, value in data['stats'].items() if key != 'users'}
             
             self.discussions = 'discussions' in data['stats']
             
@@ -119,16 +293,19 @@ class Wiki:
             }
             if self.has_admin_count:
                 for key in ['active_bureaucrats', 'active_admins']:
-                    data[key] = sorted([user['username'] for user in getattr(self, key, [])])
+                    data[key] = sorted(getattr(self, key, ()))
         else:
             data['stats'] = self.stats.copy()
         
         return data
     
-    has_details = False
     def getWikiVariables(self):
-        vars = api.getWikiVariables(self.domain)
-        
+        self.setWikiVariables(api.getWikiVariables(self.domain))
+    
+    def submitWikiVariables(self):
+        return api.then(api.submitWikiVariables(self.domain), self.setWikiVariables)
+    
+    def setWikiVariables(self, vars):
         self.mainpage = vars.get('mainPageTitle', None)
         self.categories = set(vars.get('wikiCategories', []))
         self.categories.add(self.hub.lower())
@@ -149,31 +326,69 @@ class Wiki:
         
         self.has_details = True
         
-    has_admin_count = False
     def getAdminCount(self, active_time):
-        users = self.api.getUsers(groups = self.admin_groups + self.mod_groups, edits = 0, order = 'dtedit:desc')
-        
-        self.active_bureaucrats = []
-        self.active_admins = []
-        self.active_mods = []
+        since = datetime.now() - active_time
+        self.setAdmins(*self.countAdmins(self.api.iterUsers(groups = self.admin_groups + self.mod_groups, edits = 0, order = 'dtedit:desc', since = since), since))
+    
+    def submitAdminCount(self, active_time, waiting = None):
+        # Same as getAdminCount without holding a thread, see api.submitJSON.
+        # Leaves the wiki alone and resolves to the checkpoint data instead,
+        # the caller decides whether to restore it
+        since = datetime.now() - active_time
+        users = self.api.submitUsers(groups = self.admin_groups + self.mod_groups, edits = 0, order = 'dtedit:desc', since = since, waiting = waiting)
+        return api.then(users, lambda users: dict(zip(self.admin_keys, self.countAdmins(users, since))))
+    
+    def countAdmins(self, users, since):
+        bureaucrats = []
+        admins = []
+        mods = []
         for user in users:
-            if user['last_edit'] is None or (datetime.now() - user['last_edit']) > active_time:
+            if user['last_edit'] is None or user['last_edit'] < since:
                 continue
             
             if any([x in user['groups'] for x in self.admin_groups]):
-                self.active_admins += [user]
+                admins += [user['username']]
                 if 'bureaucrat' in user['groups']:
-                    self.active_bureaucrats += [user]
+                    bureaucrats += [user['username']]
             elif any([x in user['groups'] for x in self.mod_groups]):
-                self.active_mods += [user]
+                mods += [user['username']]
+        
+        return bureaucrats, admins, mods
+    
+    def setAdmins(self, bureaucrats, admins, mods):
+        self.active_bureaucrats = tuple(bureaucrats)
+        self.active_admins = tuple(admins)
+        self.active_mods = tuple(mods)
         
         self.stats['activeBureaucrats'] = len(self.active_bureaucrats)
         self.stats['activeAdmins'] = len(self.active_admins)
         self.stats['activeMods'] = len(self.active_mods)
         self.has_admin_count = True
+    
+    admin_keys = ['active_bureaucrats', 'active_admins', 'active_mods']
+    def clearAdmins(self):
+        for key in self.admin_keys:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                pass
+        if self.stats is not None:
+            for key in ['activeBureaucrats', 'activeAdmins', 'activeMods']:
+                self.stats.pop(key, None)
+        self.has_admin_count = False
+    
+    def checkpoint(self, method):
+        if method == 'getAdminCount':
+            return {key: list(getattr(self, key)) for key in self.admin_keys}
+        raise ValueError('No checkpoint for {}'.format(method))
+    
+    def restore(self, method, data):
+        if method == 'getAdminCount':
+            return self.setAdmins(*[data[key] for key in self.admin_keys])
+        raise ValueError('No checkpoint for {}'.format(method))
 
 class WikiAPI:
-    wiki = None
+    __slots__ = ('wiki',)
     
     def __init__(self, wiki):
         self.wiki = wiki
@@ -183,44 +398,75 @@ class WikiAPI:
         return self.wiki.domain
     
     def getUsers(self, groups = [], edits = 5, order = 'revcnt:desc'):
-        query = {
+        return list(self.iterUsers(groups, edits, order))
+    
+    def usersQuery(self, groups, edits, order):
+        return {
             'uselang': 'en',
             'action': 'ajax',
             'rs': 'ListusersAjax::axShowUsers',
             'groups': ','.join(groups),
             'edits': edits,
-            'limit': '100',
+            'limit': users_batch,
+            'offset': 0,
             'order': order,
         }
-        data = api.call('/index.php', query, server = 'https://' + self.wiki.domain)
-        
-        res = []
+    
+    def parseUsers(self, data, query, since = None):
+        # Returns the users of one page and whether there is a next one, for
+        # which query is moved on. With order = 'dtedit:desc' and a since date
+        # it stops at the first user whose last edit is older than that
+        cutoff = since is not None and query['order'] == 'dtedit:desc'
         cols = data['sColumns'].split(',')
-        username_pattern = re.compile('\>([^<]+)\</a\>')
-        date_pattern = re.compile('\>([^>]*(january|february|march|april|may|june|july|august|september|october|november|december)[^<]*)\<', flags = re.I)
-        tag_pattern = re.compile('\<[^>]*\>')
+        username, dtedit, groups, revcnt = [cols.index(x) for x in ('username', 'dtedit', 'groups', 'revcnt')]
         
+        users = []
         for row in data['aaData']:
-            row = {cols[i]:v for i,v in enumerate(row)}
-            
-            user = {}
-            user['username'] = username_pattern.search(row['username']).group(1)
-            
-            m = date_pattern.search(row['dtedit'])
-            if m is not None:
-                user['last_edit'] = dateutil.parser.parse(m.group(1))
-            else:
-                user['last_edit'] = None
-            
-            user['groups'] = [x.strip() for x in tag_pattern.sub('', row['groups']).split(',')]
-            
-            user['edits'] = int(tag_pattern.sub('', row['revcnt']))
-            
-            res += [user]
+            last_edit = parseDate(row[dtedit])
+            if cutoff and last_edit is not None and last_edit < since:
+                return users, False
+            users.append({
+                'username': _username.search(row[username]).group(1),
+                'last_edit': last_edit,
+                'groups': [x.strip() for x in _tag.sub('', row[groups]).split(',')],
+                'edits': int(_tag.sub('', row[revcnt])),
+            })
+        
+        query['offset'] += len(data['aaData'])
+        return users, not (len(data['aaData']) < users_batch or query['offset'] >= int(data.get('iTotalDisplayRecords', query['offset'])))
+    
+    def iterUsers(self, groups = [], edits = 5, order = 'revcnt:desc', since = None):
+        # Pages through the whole list
+        query = self.usersQuery(groups, edits, order)
+        more = True
+        while more:
+            users, more = self.parseUsers(api.call('/index.php', query, server = 'https://' + self.wiki.domain), query, since)
+            for user in users:
+                yield user
+    
+    def submitUsers(self, groups = [], edits = 5, order = 'revcnt:desc', since = None, waiting = None):
+        # Same as iterUsers, but page after page on submitJSON. Returns the
+        # Future of the list of users
+        query = self.usersQuery(groups, edits, order)
+        res = Future()
+        users = []
+        def page(future):
+            try:
+                lst, more = self.parseUsers(future.result(), query, since)
+                users.extend(lst)
+                if more and not res.cancelled():
+                    return api.submit('/index.php', query, server = 'https://' + self.wiki.domain, waiting = waiting).add_done_callback(page)
+                res.set_result(users)
+            except Exception as e:
+                try:
+                    res.set_exception(e)
+                except Exception:
+                    pass # Cancelled in the meantime
+        api.submit('/index.php', query, server = 'https://' + self.wiki.domain, waiting = waiting).add_done_callback(page)
         return res
 
 class InvalidWiki(Wiki):
-    pass
+    __slots__ = ()
 
 class ClosedWiki(InvalidWiki):
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
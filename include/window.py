@@ -0,0 +1,88 @@
+# -*- coding: utf-8  -*-
+# Keeps a limited number of asynchronous tasks going at once. A task that waits
+# out a retry backoff does not count against the limit, so that one failing
+# host does not hold up the others.
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+class Window:
+    def __init__(self, limit):
+        self.limit = limit
+        self._queue = deque()
+        self._active = set()
+        self._pumping = False
+        self._lock = threading.Lock()
+
+    def submit(self, start):
+        # start(waiting) returns the Future of the task and calls waiting(True)
+        # and waiting(False) when it goes into and comes out of a backoff.
+        # Returns a Future that follows the task once it gets its turn
+        future = Future()
+        with self._lock:
+            self._queue.append((future, start))
+        self.pump()
+        return future
+
+    def clear(self):
+        with self._lock:
+            queued, self._queue = self._queue, deque()
+        for future, start in queued:
+            future.cancel()
+
+    def pump(self):
+        # Only one thread starts tasks at a time. Tasks that are done right
+        # away call back in here and return at once, the loop picks up the
+        # freed slot instead
+        with self._lock:
+            if self._pumping:
+                return
+            self._pumping = True
+        while True:
+            with self._lock:
+                while len(self._queue) and self._queue[0][0].cancelled():
+                    self._queue.popleft()
+                if len(self._queue) == 0 or len(self._active) >= self.limit:
+                    self._pumping = False
+                    return
+                future, start = self._queue.popleft()
+                self._active.add(future)
+            self.start(future, start)
+
+    def start(self, future, start):
+        def waiting(flag):
+            with self._lock:
+                if flag:
+                    self._active.discard(future)
+                elif not future.done():
+                    self._active.add(future)
+            if flag:
+                self.pump()
+
+        def done(task):
+            with self._lock:
+                self._active.discard(future)
+            try:
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+            except Exception:
+                pass # Cancelled in the meantime
+            self.pump()
+
+        try:
+            task = start(waiting)
+        except Exception as e:
+            with self._lock:
+                self._active.discard(future)
+            try:
+                future.set_exception(e)
+            except Exception:
+                pass
+            return
+        future.add_done_callback(lambda future: future.cancelled() and task.cancel())
+        task.add_done_callback(done)
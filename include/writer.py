@@ -0,0 +1,82 @@
+# -*- coding: utf-8  -*-
+# Background queue for page writes, so that the next payload is prepared while
+# the previous one is being saved. The pace adapts to the wiki: maxlag, rate
+# limit and server errors double the delay between edits, fast saves halve it.
+
+import threading, queue, time
+import pywikibot
+from pywikibot.data.api import APIError
+
+queue_size = 20
+max_tries = 3
+
+min_delay = 0
+max_delay = 60
+slow_write = 10 # seconds a put may take before it counts as a sign of lag
+
+lag_codes = ['maxlag', 'ratelimited', 'readonly']
+
+class Writer:
+    def __init__(self):
+        self.delay = min_delay
+        self.errors = []
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._thread = None
+
+    def put(self, page, text, summary, callback = None, **kwargs):
+        # Blocks while the queue is full
+        if self._thread is None:
+            self._thread = threading.Thread(target = self.run, daemon = True)
+            self._thread.start()
+        self._queue.put((page, text, summary, callback, kwargs))
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self.write(*job)
+            except Exception as e:
+                # Whatever failed, the thread has to live on or flush and put
+                # would wait for it forever
+                self.errors.append((job[0], e))
+            finally:
+                self._queue.task_done()
+
+    def slowDown(self):
+        self.delay = min(max_delay, max(1, self.delay * 2))
+
+    def speedUp(self):
+        self.delay = self.delay / 2 if self.delay > 1 else min_delay
+
+    def write(self, page, text, summary, callback, kwargs):
+        for attempt in range(max_tries):
+            if self.delay:
+                time.sleep(self.delay)
+            start = time.time()
+            try:
+                page.put(text, summary, **kwargs)
+            except (APIError, pywikibot.exceptions.ServerError) as e:
+                lagged = isinstance(e, pywikibot.exceptions.ServerError) or e.code in lag_codes
+                if not lagged or attempt + 1 == max_tries:
+                    self.errors.append((page, e))
+                    return
+                self.slowDown()
+                continue
+            except Exception as e:
+                self.errors.append((page, e))
+                return
+
+            seconds = time.time() - start
+            if seconds > slow_write:
+                self.slowDown()
+            else:
+                self.speedUp()
+            if callback is not None:
+                callback(page, text, seconds)
+            return
+
+    def flush(self):
+        # Waits for every queued write and returns the errors collected so far
+        self._queue.join()
+        errors, self.errors = self.errors, []
+        return errors
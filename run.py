@@ -9,9 +9,16 @@ from pprint import pprint
 def main():
     import pywikibot
     from include.bot import Bot
+    from include import multisite
     try:
-        bot = Bot()
-        bot.run()
+        args = pywikibot.handle_args()
+        sites = [site for arg in args if arg.startswith('-sites:') for site in arg[7:].split(',') if site]
+        args = [arg for arg in args if not arg.startswith('-sites:')]
+        if len(sites):
+            multisite.run(sites, args)
+        else:
+            bot = Bot(args = args)
+            bot.run()
     except (pywikibot.bot.QuitKeyboardInterrupt, KeyboardInterrupt):
         pywikibot.output('\r\n\03{lightyellow}Quitting\03{default}')
         try: